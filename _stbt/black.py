@@ -16,8 +16,8 @@ from builtins import *  # pylint:disable=redefined-builtin,unused-wildcard-impor
 import cv2
 
 from .config import get_config
-from .imgutils import (_frame_repr, _image_region, _ImageFromUser, _load_image,
-                       pixel_bounding_box, crop)
+from .imgutils import (_derived_images, _frame_repr, _image_region,
+                       _ImageFromUser, _load_image, pixel_bounding_box, crop)
 from .logging import debug, ImageLogger
 from .types import Region
 
@@ -81,10 +81,11 @@ def is_screen_black(frame=None, mask=None, threshold=None, region=Region.ALL):
     imglog.imwrite("source", frame)
 
     _region = Region.intersect(_image_region(frame), region)
-    greyframe = cv2.cvtColor(crop(frame, _region), cv2.COLOR_BGR2GRAY)
+    greyframe = _derived_images.get(crop(frame, _region), "gray",
+                                    cv2.cvtColor, cv2.COLOR_BGR2GRAY)
     if mask.image is not None:
         imglog.imwrite("mask", mask.image)
-        cv2.bitwise_and(greyframe, mask.image, dst=greyframe)
+        greyframe = cv2.bitwise_and(greyframe, mask.image)
     maxVal = greyframe.max()
 
     result = _IsScreenBlackResult(bool(maxVal <= threshold), frame)
@@ -34,7 +34,8 @@ import _stbt.cv2_compat as cv2_compat
 from _stbt import logging
 from _stbt.config import get_config
 from _stbt.gst_utils import array_from_sample, gst_sample_make_writable
-from _stbt.imgutils import _frame_repr, find_user_file, Frame, imread
+from _stbt.imgutils import (_frame_repr, _imread_cached, find_user_file,
+                            Frame)
 from _stbt.logging import ddebug, debug, warn
 from _stbt.types import Region, UITestError, UITestFailure
 from _stbt.utils import to_unicode
@@ -82,15 +83,19 @@ def load_image(filename, flags=None):
     * Added in v28.
     * Changed in v30: Include alpha (transparency) channel if the file has
       transparent pixels.
+    * Changed in v31: Decoded images are cached in memory (and on disk, if
+      ``disk_cache`` is enabled in the ``[load_image]`` section of
+      :ref:`.stbt.conf`). Each call returns a new copy, so you can modify it.
     """
 
     absolute_filename = find_user_file(filename)
     if not absolute_filename:
         raise IOError("No such file: %s" % filename)
-    image = imread(absolute_filename, flags)
+    image = _imread_cached(absolute_filename, flags)
     if image is None:
         raise IOError("Failed to load image: %s" % absolute_filename)
-    return image
+    # The cached image is read-only & shared with other callers:
+    return image.copy()
 
 
 def new_device_under_test_from_config(parsed_args=None):
@@ -15,7 +15,9 @@ version = LooseVersion(cv2.__version__).version
 
 if version >= [3, 2, 0]:
     def find_contour_boxes(image, mode, method):  # pylint:disable=redefined-outer-name
-        contours = cv2.findContours(image=image, mode=mode, method=method)[1]
+        # OpenCV 3 returns (img, contours, hierarchy); OpenCV 4 returns
+        # (contours, hierarchy):
+        contours = cv2.findContours(image=image, mode=mode, method=method)[-2]
         return [cv2.boundingRect(x) for x in contours]
 else:
     def _fix_pre_3_2_rects(r):
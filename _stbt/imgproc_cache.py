@@ -4,9 +4,9 @@ purposes of speeding up subsequent runs of stbt auto-selftest.
 
 To enable caching, decorate the cachable function with `imgproc_cache.memoize`
 and call the function within the scope of a `with imgproc_cache.cache():`
-context manager. For now this is a private API but we intend to make it public
-at some point so that users can add caching to any custom image-processing
-functions in their test-packs.
+context manager. `memoize` is also available to users as `stbt.memoize`, so
+that they can add caching to any custom image-processing functions in their
+test-packs.
 """
 from __future__ import unicode_literals
 from __future__ import print_function
@@ -16,18 +16,24 @@ from builtins import *  # pylint:disable=redefined-builtin,unused-wildcard-impor
 
 import functools
 import inspect
+import io
 import itertools
 import json
 import os
+import struct
 import sys
+import threading
+import time
+from collections import OrderedDict
 from contextlib import contextmanager
 from distutils.version import LooseVersion
 
 import lmdb
 import numpy
 
-from _stbt.logging import ImageLogger
+from _stbt.logging import debug, ImageLogger
 from _stbt.utils import mkdir_p, named_temporary_directory, scoped_curdir
+from _stbt.xxhash import Xxhash64
 
 try:
     from itertools import zip_longest
@@ -37,35 +43,104 @@ except ImportError:
 
 
 MAX_CACHE_SIZE_BYTES = 1024 * 1024 * 1024  # 1GiB
+# When the cache is full, delete the least-recently-used entries to free up
+# this fraction of its size:
+EVICT_FRACTION = 0.25
+MAX_MEMORY_CACHE_ENTRIES = 10000
+MAX_MEMORY_CACHE_BYTES = 64 * 1024 * 1024  # 64MiB
+WRITE_BEHIND_INTERVAL_SECS = 1.0
+WRITE_BEHIND_MAX_PENDING = 1000
+# Each thread that is reading from the cache uses a slot in LMDB's reader table,
+# so a cache shared by many processes needs more than the default of 126.
+SHARED_MAX_READERS = 1024
 _cache = None
 _cache_full_warning = None
+_memory_cache = None
+_writer = None
+_stats = OrderedDict()  # function name -> CacheStats
+_stats_lock = threading.Lock()
+
+
+def default_filename():
+    """The shared cache configured by ``shared_path`` in the ``[cache]``
+    section of the configuration file, if any; otherwise a per-user cache."""
+    from _stbt.config import get_config
+    shared_path = get_config("cache", "shared_path", "")
+    if shared_path:
+        return shared_path
+    cache_home = os.environ.get('XDG_CACHE_HOME') \
+        or '%s/.cache' % os.environ['HOME']
+    return cache_home + "/stbt/cache.lmdb"
 
 
 @contextmanager
-def cache(filename=None):
+def cache(filename=None, max_size_bytes=None, shared=None):
+    """Enables the cache for memoized functions called within this context.
+
+    :param str filename: Path to the LMDB database. Defaults to
+        `default_filename()`.
+    :param int max_size_bytes: Defaults to ``max_size_mb`` from the
+        ``[cache]`` section of the configuration file.
+    :param bool shared: Set this if several processes will use the same cache
+        at the same time (for example parallel ``stbt run`` processes testing
+        different devices on the same host). Defaults to True if
+        ``shared_path`` is set in the ``[cache]`` section of the configuration
+        file and `filename` isn't specified.
+
+    Any number of processes can read from the cache at the same time without
+    waiting for each other; writes are serialised by LMDB's writer lock (each
+    process batches its writes, see `_WriteBehind`). In shared mode we allow
+    more concurrent readers, and clear reader slots left behind by processes
+    that have died.
+    """
     if os.environ.get('STBT_DISABLE_CACHING'):
         yield
         return
 
     global _cache
     global _cache_full_warning
+    global _memory_cache
+    global _writer
 
+    from _stbt.config import get_config
+    if shared is None:
+        shared = (filename is None and
+                  bool(get_config("cache", "shared_path", "")))
     if filename is None:
-        cache_home = os.environ.get('XDG_CACHE_HOME') \
-            or '%s/.cache' % os.environ['HOME']
-        mkdir_p(cache_home + "/stbt")
-        filename = cache_home + "/stbt/cache.lmdb"
-    with lmdb.open(filename, map_size=MAX_CACHE_SIZE_BYTES) as db:  # pylint: disable=no-member
+        filename = default_filename()
+        mkdir_p(os.path.dirname(filename))
+    if max_size_bytes is None:
+        max_size_bytes = get_config(
+            "cache", "max_size_mb", MAX_CACHE_SIZE_BYTES // 1024 // 1024,
+            type_=int) * 1024 * 1024
+
+    kwargs = {}
+    if shared:
+        kwargs["max_readers"] = SHARED_MAX_READERS
+    with lmdb.open(filename, map_size=max_size_bytes, max_dbs=1,  # pylint: disable=no-member
+                   **kwargs) as db:
+        if shared:
+            stale = db.reader_check()
+            if stale:
+                debug("Image processing cache: Cleared %i stale readers"
+                      % stale)
         assert _cache is None
         try:
             _cache = db
             _cache_full_warning = False
+            _memory_cache = _LruCache(
+                MAX_MEMORY_CACHE_ENTRIES, MAX_MEMORY_CACHE_BYTES)
+            _writer = _WriteBehind(db)
             yield
         finally:
+            if _writer is not None:
+                _writer.close()
             _cache = None
+            _memory_cache = None
+            _writer = None
 
 
-def memoize(additional_fields=None):
+def memoize(additional_fields=None, serializer=None):
     """
     A decorator to say that the results of a function should be cached.  This is
     used to short circuit expensive image processing functions like OCR.
@@ -74,13 +149,35 @@ def memoize(additional_fields=None):
     fields specified to the decorator.  This is used as a key to retrieve a
     previously calculated result from a database on disk.
 
+    Results are only cached while the image-processing cache is enabled;
+    at other times the decorated function is called as normal. The cache is
+    enabled while ``stbt auto-selftest`` is running the self-tests. To enable
+    it in ``stbt run`` too, set ``stbt_run = true`` in the ``[cache]`` section
+    of the configuration file.
+
+    :param dict additional_fields: Anything else that affects the result (for
+        example a version number that you increment when you change the
+        function's implementation).
+
+    :param serializer: How to store the return value:
+
+        * ``"json"`` (the default): Values that can be round-tripped via JSON.
+          This means that unicode objects should be returned rather than
+          string objects, and tuples will be returned as lists.
+        * ``"numpy"``: A single `numpy.ndarray`.
+        * ``"stbt"``: Like ``"json"``, but also supports numpy arrays,
+          `stbt.Frame`, `stbt.Region`, `stbt.Position`, `stbt.MatchResult`
+          and `stbt.TextMatchResult` anywhere in the value.
+        * An object with methods ``dumps(value) -> bytes`` and
+          ``loads(bytes) -> value``, and a ``name`` attribute that
+          identifies the format.
+
     **Constraints**
 
     * The decorated function's arguments must be simple JSON serialisable
       values or an image in the form of a numpy.ndarray.
-    * The return value from the function must be JSON serialisable and should
-      be round-trippable via JSON. This means that unicode objects should be
-      returned rather than string objects.
+    * The return value from the function must be supported by the
+      `serializer`.
     * For the sake of speed we use a non-cryptographic hash function.  This
       means someone could deliberately cause a hash-collision by carefully
       constructing arguments to your function.  Don't use memoize on functions
@@ -96,14 +193,22 @@ def memoize(additional_fields=None):
     * This means that memoize works best on functions that take large amounts of
       data (like frames of video) and boil it down to a small amount of data
       (like a MatchResult or OCR text).
-
-    This function is not a part of the stbt public API and may change without
-    warning in future releases.  We hope to stabilise it in the future so users
-    can use it with their custom image-processing functions.
+    * Recently used results are also kept in memory (already decoded), so the
+      same result may be returned to several callers. Don't modify the return
+      value. (Arrays returned by the "numpy" and "stbt" serializers are
+      read-only.)
     """
+    serializer = _get_serializer(serializer)
+
     def decorator(f):
-        func_key = json.dumps([f.__name__, additional_fields],
-                              sort_keys=True)
+        if serializer is _JSON_SERIALIZER:
+            func_key = json.dumps([f.__name__, additional_fields],
+                                  sort_keys=True)
+        else:
+            func_key = json.dumps(
+                [f.__name__, additional_fields, serializer.name],
+                sort_keys=True)
+        name = _function_name(f)
 
         @functools.wraps(f)
         def inner(*args, **kwargs):
@@ -113,14 +218,20 @@ def memoize(additional_fields=None):
                 full_kwargs = inspect.getcallargs(f, *args, **kwargs)  # pylint:disable=deprecated-method
                 key = _cache_hash((func_key, full_kwargs))
             except NotCachable:
+                if _cache is not None:
+                    _record_stats(name, uncachable=1)
                 return f(*args, **kwargs)
 
-            with _cache.begin() as txn:
-                out = txn.get(key)
-            if out is not None:
-                return json.loads(out)
+            out = _cache_get(key, serializer)
+            if out is not _MISSING:
+                _record_stats(name, hits=1)
+                return out
+            start = time.time()
             output = f(**full_kwargs)
-            _cache_put(key, output)
+            miss_secs = time.time() - start
+            nbytes = _cache_put(key, output, name, serializer)
+            _record_stats(name, misses=1, miss_secs=miss_secs,
+                          stored_bytes=nbytes)
             return output
 
         return inner
@@ -136,6 +247,7 @@ def memoize_iterator(additional_fields=None):
     def decorator(f):
         func_key = json.dumps([f.__name__, additional_fields],
                               sort_keys=True)
+        name = _function_name(f)
 
         @functools.wraps(f)
         def inner(*args, **kwargs):
@@ -145,16 +257,19 @@ def memoize_iterator(additional_fields=None):
                 full_kwargs = inspect.getcallargs(f, *args, **kwargs)  # pylint:disable=deprecated-method
                 key = _cache_hash((func_key, full_kwargs))
             except NotCachable:
+                if _cache is not None:
+                    _record_stats(name, uncachable=1)
                 for x in f(*args, **kwargs):
                     yield x
                 return
 
+            # Each item of the iterator counts as a hit or a miss.
             for i in itertools.count():
-                with _cache.begin() as txn:
-                    out = txn.get(key + str(i).encode())
-                if out is None:
+                out = _cache_get(key + str(i).encode())
+                if out is _MISSING:
                     break
-                out_, stop_ = json.loads(out)
+                _record_stats(name, hits=1)
+                out_, stop_ = out
                 if stop_:
                     return
                 yield out_
@@ -162,79 +277,668 @@ def memoize_iterator(additional_fields=None):
             skip = i  # pylint:disable=undefined-loop-variable
             it = f(**full_kwargs)
             for i in itertools.count():
+                start = time.time()
                 try:
                     output = next(it)
                     if i >= skip:
-                        _cache_put(key + str(i).encode(), [output, None])
+                        nbytes = _cache_put(key + str(i).encode(),
+                                            [output, None], name)
+                        _record_stats(name, misses=1,
+                                      miss_secs=time.time() - start,
+                                      stored_bytes=nbytes)
                         yield output
                 except StopIteration:
-                    _cache_put(key + str(i).encode(), [None, "StopIteration"])
-                    raise
+                    nbytes = _cache_put(key + str(i).encode(),
+                                        [None, "StopIteration"], name)
+                    _record_stats(name, misses=1,
+                                  miss_secs=time.time() - start,
+                                  stored_bytes=nbytes)
+                    return
 
         return inner
     return decorator
 
 
-def _cache_put(key, value):
-    with _cache.begin(write=True) as txn:
+_MISSING = object()
+
+
+def _cache_get(key, serializer=None):
+    """Returns the cached value for `key`, or `_MISSING`."""
+    if serializer is None:
+        serializer = _JSON_SERIALIZER
+    value = _memory_cache.get(key)
+    if value is not _MISSING:
+        _writer.touch(key)
+    else:
+        out = _writer.get(key)
+        if out is None:
+            with _cache.begin() as txn:
+                out = txn.get(key)
+        if out is None:
+            return _MISSING
+        value = serializer.loads(out)
+        _memory_cache.put(key, value, len(out))
+        _writer.touch(key)
+    return value
+
+
+def _cache_put(key, value, name, serializer=None):
+    """Returns the number of bytes stored."""
+    if serializer is None:
+        serializer = _JSON_SERIALIZER
+    data = serializer.dumps(value)
+    # Store the decoded value rather than `value` itself, so that we return the
+    # same thing whether the result comes from memory or from disk.
+    _memory_cache.put(key, serializer.loads(data), len(data))
+    _writer.put(key, data, name)
+    return len(key) + len(data)
+
+
+class _JsonSerializer(object):
+    name = "json"
+
+    def dumps(self, value):
+        return json.dumps(value).encode("utf-8")
+
+    def loads(self, data):
+        return json.loads(bytes(data).decode("utf-8"))
+
+
+class _NumpySerializer(object):
+    """A single array, in numpy's ".npy" format."""
+    name = "numpy"
+
+    def dumps(self, value):
+        f = io.BytesIO()
+        numpy.save(f, value, allow_pickle=False)
+        return f.getvalue()
+
+    def loads(self, data):
+        a = numpy.load(io.BytesIO(data), allow_pickle=False)
+        a.flags.writeable = False
+        return a
+
+
+class _StbtSerializer(object):
+    """JSON, extended with numpy arrays and stbt's result types.
+
+    The format is the length of the JSON header (uint32), the JSON header, and
+    then the contents of each array. In the header each array is replaced by
+    ``{"__ndarray__": [dtype, shape]}`` and each stbt type by
+    ``{"__stbt__": [type name, {field: value}]}``.
+    """
+    name = "stbt"
+    _HEADER_LENGTH = struct.Struct("<I")
+
+    def dumps(self, value):
+        arrays = []
+        header = json.dumps(self._encode(value, arrays)).encode("utf-8")
+        return b"".join(
+            [self._HEADER_LENGTH.pack(len(header)), header] +
+            [numpy.ascontiguousarray(a).tobytes() for a in arrays])
+
+    def loads(self, data):
+        data = memoryview(data)
+        n, = self._HEADER_LENGTH.unpack_from(data)
+        offset = [self._HEADER_LENGTH.size + n]
+
+        def decode(o):
+            if "__ndarray__" in o:
+                dtype, shape = o["__ndarray__"]
+                dtype = numpy.dtype(str(dtype))
+                count = int(numpy.prod(shape))
+                a = numpy.frombuffer(
+                    data, dtype=dtype, count=count, offset=offset[0]
+                ).reshape(shape)
+                offset[0] += count * dtype.itemsize
+                return a
+            elif "__stbt__" in o:
+                type_name, fields = o["__stbt__"]
+                return _stbt_types()[type_name](**fields)
+            else:
+                return o
+
+        return json.loads(
+            bytes(data[self._HEADER_LENGTH.size:offset[0]]).decode("utf-8"),
+            object_hook=decode)
+
+    def _encode(self, o, arrays):
+        from _stbt.imgutils import Frame
+        type_name = type(o).__name__
+        if isinstance(o, Frame):
+            return {"__stbt__": ["Frame", {
+                "array": self._encode(o.view(numpy.ndarray), arrays),
+                "time": o.time}]}
+        elif _stbt_types().get(type_name) is type(o):
+            return {"__stbt__": [type_name, dict(
+                (field, self._encode(getattr(o, field), arrays))
+                for field in o._fields)]}
+        elif isinstance(o, numpy.ndarray):
+            arrays.append(o)
+            return {"__ndarray__": [o.dtype.str, o.shape]}
+        elif isinstance(o, (list, tuple)):
+            return [self._encode(x, arrays) for x in o]
+        elif isinstance(o, dict):
+            return dict((k, self._encode(v, arrays)) for k, v in o.items())
+        else:
+            return o
+
+
+def _stbt_types():
+    from _stbt.imgutils import Frame
+    from _stbt.match import MatchResult, Position
+    from _stbt.ocr import TextMatchResult
+    from _stbt.types import Region
+    return {
+        "Frame": Frame,
+        "MatchResult": MatchResult,
+        "Position": Position,
+        "Region": Region,
+        "TextMatchResult": TextMatchResult,
+    }
+
+
+_JSON_SERIALIZER = _JsonSerializer()
+_SERIALIZERS = {
+    "json": _JSON_SERIALIZER,
+    "numpy": _NumpySerializer(),
+    "stbt": _StbtSerializer(),
+}
+
+
+def _get_serializer(serializer):
+    if serializer is None:
+        return _JSON_SERIALIZER
+    if all(hasattr(serializer, x) for x in ("dumps", "loads", "name")):
+        return serializer
+    try:
+        return _SERIALIZERS[serializer]
+    except (KeyError, TypeError):
+        raise ValueError(
+            "Unknown serializer %r. Expected one of %s, or an object with "
+            "`dumps`, `loads` and `name` attributes" % (
+                serializer, ", ".join(sorted(_SERIALIZERS))))
+
+
+class CacheStats(object):
+    """Counters for one memoized function, since the start of the process.
+
+    * ``hits``: Results returned from the cache.
+    * ``misses``: Results that we had to calculate (and then stored).
+    * ``uncachable``: Calls that bypassed the cache because an argument
+      couldn't be cached (e.g. when debug image logging is enabled).
+    * ``miss_secs``: Total time spent calculating the misses.
+    * ``stored_bytes``: Total size of the results that we stored.
+    """
+    __slots__ = ["hits", "misses", "uncachable", "miss_secs", "stored_bytes"]
+
+    def __init__(self, hits=0, misses=0, uncachable=0, miss_secs=0.,
+                 stored_bytes=0):
+        self.hits = hits
+        self.misses = misses
+        self.uncachable = uncachable
+        self.miss_secs = miss_secs
+        self.stored_bytes = stored_bytes
+
+    @property
+    def time_saved_secs(self):
+        """Estimated from the average time taken by a miss."""
+        if not self.misses:
+            return 0.
+        return self.hits * self.miss_secs / self.misses
+
+    def __repr__(self):
+        return (
+            "CacheStats(hits=%r, misses=%r, uncachable=%r, miss_secs=%r, "
+            "stored_bytes=%r)" % (self.hits, self.misses, self.uncachable,
+                                  self.miss_secs, self.stored_bytes))
+
+
+def _function_name(f):
+    return "%s.%s" % (f.__module__, f.__name__)
+
+
+def _record_stats(name, hits=0, misses=0, uncachable=0, miss_secs=0.,
+                  stored_bytes=0):
+    with _stats_lock:
+        s = _stats.get(name)
+        if s is None:
+            s = _stats[name] = CacheStats()
+        s.hits += hits
+        s.misses += misses
+        s.uncachable += uncachable
+        s.miss_secs += miss_secs
+        s.stored_bytes += stored_bytes
+
+
+def stats():
+    """Returns a dict of memoized function name -> `CacheStats`."""
+    with _stats_lock:
+        return OrderedDict(
+            (name, CacheStats(s.hits, s.misses, s.uncachable, s.miss_secs,
+                              s.stored_bytes))
+            for name, s in _stats.items())
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def format_stats(stats_=None):
+    """Summary of `stats()` as a table, or "" if no memoized functions have
+    been called with the cache enabled."""
+    if stats_ is None:
+        stats_ = stats()
+    if not stats_:
+        return ""
+    lines = ["%-40s %8s %8s %10s %10s %10s" % (
+        "Function", "Hits", "Misses", "Uncachable", "Saved (s)", "Stored")]
+    for name, s in stats_.items():
+        lines.append("%-40s %8i %8i %10i %10.2f %10s" % (
+            name, s.hits, s.misses, s.uncachable, s.time_saved_secs,
+            _format_bytes(s.stored_bytes)))
+    return "\n".join(lines) + "\n"
+
+
+def _format_bytes(n):
+    for unit in ["B", "KiB", "MiB"]:
+        if n < 1024:
+            return "%i %s" % (n, unit) if unit == "B" else \
+                "%.1f %s" % (n, unit)
+        n /= 1024
+    return "%.1f GiB" % n
+
+
+def file_stats(filename=None):
+    """Inspects the cache database on disk.
+
+    Returns a dict with the size of the database and, for each memoized
+    function, the number of entries, their total size in bytes, and the last
+    time any of them was used (seconds since the epoch).  Entries written
+    before we recorded which function they belong to are listed under "".
+    """
+    if filename is None:
+        filename = default_filename()
+    # map_size=0 means use the size that the database was created with.
+    with lmdb.open(filename, readonly=True, max_dbs=1, map_size=0) as db:  # pylint: disable=no-member
+        functions = {}
+        with db.begin() as txn:
+            try:
+                atimes = db.open_db(b"atime", txn=txn, create=False)
+            except lmdb.NotFoundError:  # pylint: disable=no-member
+                atimes = None
+            for key, value in txn.cursor():
+                if key == b"atime":
+                    continue  # The atime database itself
+                atime, size, name = 0., len(key) + len(value), ""
+                record = None
+                if atimes is not None:
+                    record = txn.get(key, db=atimes)
+                if record is not None:
+                    atime, size, name = _unpack_atime(record)
+                entries, nbytes, last_used = functions.get(name, (0, 0, 0.))
+                functions[name] = (entries + 1, nbytes + size,
+                                   max(last_used, atime))
+        info = db.info()
+        stat = db.stat()
+        return {
+            "filename": filename,
+            "map_size": info["map_size"],
+            "used_bytes": (info["last_pgno"] + 1) * stat["psize"],
+            "functions": OrderedDict(
+                (name, {"entries": e, "bytes": b, "last_used": t})
+                for name, (e, b, t) in sorted(functions.items())),
+        }
+
+
+def _warn_cache_full():
+    global _cache_full_warning
+    if not _cache_full_warning:
+        sys.stderr.write(
+            "Image processing cache is full.  This will "
+            "cause degraded performance.  Consider "
+            "deleting the cache file (%s) to purge old "
+            "results\n" % _cache.path())
+        _cache_full_warning = True
+
+
+class _WriteBehind(object):
+    """Writes puts to the LMDB database in batches, on a background thread.
+
+    Each LMDB write transaction syncs to disk when it commits, so writing every
+    result in its own transaction puts disk latency in the middle of hot
+    image-processing loops. Instead we queue the puts and write them in a
+    single transaction every `WRITE_BEHIND_INTERVAL_SECS` (or sooner if
+    `WRITE_BEHIND_MAX_PENDING` puts are queued). Until then `get` returns the
+    queued value.
+
+    We also record when each entry was last used (in the "atime" database) so
+    that when the cache is full we can evict the least-recently-used entries.
+    Results from old versions of a memoized function (old `additional_fields`)
+    are never used again, so they become the least-recently-used entries and
+    are evicted before any results that are still being used.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.atimes = db.open_db(b"atime")
+        self._pending = OrderedDict()  # key -> JSON-encoded bytes
+        self._touched = OrderedDict()  # key -> (time, function name or None)
+        self._seen = set()  # Keys touched during this session
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._warned = False
+        self._thread = threading.Thread(
+            target=self._run, name="imgproc_cache write-behind")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, key, data, name):
+        with self._cond:
+            self._pending[key] = data
+            self._touched[key] = (time.time(), name)
+            self._seen.add(key)
+            if len(self._pending) >= WRITE_BEHIND_MAX_PENDING:
+                self._cond.notify()
+
+    def get(self, key):
+        with self._cond:
+            return self._pending.get(key)
+
+    def touch(self, key):
+        """Record that `key` has been used.
+
+        We only do this once per session: eviction doesn't need more precision
+        than that.
+        """
+        with self._cond:
+            if key not in self._seen:
+                self._seen.add(key)
+                self._touched[key] = (time.time(), None)
+
+    def flush(self):
+        with self._cond:
+            batch = list(self._pending.items())
+            touched = list(self._touched.items())
+            self._touched.clear()
+        if not batch and not touched:
+            return
         try:
-            txn.put(key, json.dumps(value).encode("utf-8"))
-        except lmdb.MapFullError:  # pylint: disable=no-member
-            global _cache_full_warning
-            if not _cache_full_warning:
+            for attempt in range(2):
+                try:
+                    failed_at = time.time()
+                    self._write(batch, touched)
+                    break
+                except lmdb.MapFullError:  # pylint: disable=no-member
+                    if attempt == 0:
+                        self.evict(int(self.db.info()["map_size"] *
+                                       EVICT_FRACTION),
+                                   unless_evicted_since=failed_at)
+                    else:
+                        _warn_cache_full()
+        finally:
+            # If the write failed we drop the batch rather than retrying it,
+            # so that `_pending` can't grow without bound if the database
+            # can't be written (the values are still in `_memory_cache`).
+            with self._cond:
+                # Values that were replaced during the write stay queued.
+                for key, data in batch:
+                    if self._pending.get(key) is data:
+                        del self._pending[key]
+
+    def _flush_or_warn(self):
+        try:
+            self.flush()
+        except Exception as e:  # pylint:disable=broad-except
+            if not self._warned:
                 sys.stderr.write(
-                    "Image processing cache is full.  This will "
-                    "cause degraded performance.  Consider "
-                    "deleting the cache file (%s) to purge old "
-                    "results\n" % _cache.path())
-                _cache_full_warning = True
+                    "Failed to write to the image processing cache (%s): "
+                    "%s\n" % (self.db.path(), e))
+                self._warned = True
+            else:
+                debug("Failed to write to the image processing cache: %s"
+                      % e)
+
+    def _write(self, batch, touched):
+        with self.db.begin(write=True) as txn:
+            for key, data in batch:
+                txn.put(key, data)
+            sizes = dict((key, len(key) + len(data)) for key, data in batch)
+            for key, (atime, name) in touched:
+                size = sizes.get(key)
+                if size is None or name is None:
+                    old = txn.get(key, db=self.atimes)
+                    if old is not None:
+                        _, old_size, old_name = _unpack_atime(old)
+                        size = size or old_size
+                        name = name or old_name
+                    elif size is None:
+                        # Written before we recorded access times
+                        value = txn.get(key)
+                        if value is None:
+                            continue
+                        size = len(key) + len(value)
+                txn.put(key, _pack_atime(atime, size, name or ""),
+                        db=self.atimes)
+
+    def evict(self, nbytes, unless_evicted_since=None):
+        """Delete the least-recently-used entries, totalling at least `nbytes`
+        (keys + values).
+
+        When several processes share the cache they will all find that it's
+        full at about the same time. Only the first of them evicts entries:
+        the others skip eviction if it has happened since
+        `unless_evicted_since`.
+        """
+        try:
+            with self.db.begin(write=True) as txn:
+                last = txn.get(_LAST_EVICTION_KEY, db=self.atimes)
+                if (unless_evicted_since is not None and last is not None and
+                        _TIME.unpack(last)[0] >= unless_evicted_since):
+                    return
+                txn.put(_LAST_EVICTION_KEY, _TIME.pack(time.time()),
+                        db=self.atimes)
+        except lmdb.MapFullError:  # pylint: disable=no-member
+            pass  # Too full to record it, but we can still evict
+
+        with self.db.begin() as txn:
+            entries = []
+            for key, value in txn.cursor():
+                if key == b"atime":
+                    continue  # The atime database itself
+                atime = txn.get(key, db=self.atimes)
+                if atime is not None:
+                    atime, _, _ = _unpack_atime(atime)
+                else:
+                    atime = 0.
+                entries.append((atime, key, len(key) + len(value)))
+        entries.sort()
+        victims = []
+        freed = 0
+        for _, key, size in entries:
+            if freed >= nbytes:
+                break
+            victims.append(key)
+            freed += size
+
+        # LMDB can't reuse the pages freed by a transaction until another
+        # transaction has been committed after it, so we delete in two halves
+        # to make space available to the next transaction straight away.
+        half = (len(victims) + 1) // 2
+        evicted = 0
+        for keys in (victims[:half], victims[half:]):
+            try:
+                with self.db.begin(write=True) as txn:
+                    for key in keys:
+                        txn.delete(key)
+                        txn.delete(key, db=self.atimes)
+            except lmdb.MapFullError:  # pylint: disable=no-member
+                # Deleting needs free pages too: If there aren't any we can't
+                # evict anything.
+                break
+            evicted += len(keys)
+        debug("Image processing cache is full: Evicted %i least-recently-used "
+              "entries" % evicted)
+
+    def close(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
+        self._flush_or_warn()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopping:
+                    self._cond.wait(WRITE_BEHIND_INTERVAL_SECS)
+                if self._stopping:
+                    return
+            # Errors mustn't kill this thread, or nothing would be written for
+            # the rest of the test run:
+            self._flush_or_warn()
+
+
+# Value in the "atime" database: last-access time and size of the entry,
+# followed by the name of the memoized function that it belongs to.
+_ATIME = struct.Struct("<dI")
+
+# In the "atime" database: When entries were last evicted (by any process).
+_LAST_EVICTION_KEY = b"\0last-eviction"
+_TIME = struct.Struct("<d")
+
+
+def _pack_atime(atime, size, name):
+    return _ATIME.pack(atime, size) + name.encode("utf-8")
+
+
+def _unpack_atime(value):
+    atime, size = _ATIME.unpack_from(value)
+    return atime, size, bytes(value[_ATIME.size:]).decode("utf-8")
 
 
 class NotCachable(Exception):
     pass
 
 
-class _ArgsEncoder(json.JSONEncoder):
-    def default(self, o):  # pylint:disable=method-hidden
-        from _stbt.match import MatchParameters
-        if isinstance(o, ImageLogger):
-            if o.enabled:
-                raise NotCachable()
-            return None
-        elif isinstance(o, LooseVersion):
-            return str(o)
-        elif isinstance(o, set):
-            return sorted(o)
-        elif isinstance(o, MatchParameters):
-            return {
-                "match_method": o.match_method.value,
-                "match_threshold": o.match_threshold,
-                "confirm_method": o.confirm_method.value,
-                "confirm_threshold": o.confirm_threshold,
-                "erode_passes": o.erode_passes}
-        elif isinstance(o, numpy.ndarray):
-            from _stbt.xxhash import Xxhash64
-            h = Xxhash64()
-            h.update(numpy.ascontiguousarray(o).data)
-            return (o.shape, h.hexdigest())
-        else:
-            json.JSONEncoder.default(self, o)
+class _LruCache(object):
+    """In-memory cache of decoded results, in front of the LMDB database.
+
+    Bounded by the number of entries and by the size of their JSON encoding.
+    """
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, nbytes = self._entries.pop(key)
+            except KeyError:
+                return _MISSING
+            self._entries[key] = (value, nbytes)  # Most recently used
+            return value
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[1]
+            self._entries[key] = (value, nbytes)
+            self._nbytes += nbytes
+            while (len(self._entries) > self.max_entries or
+                   self._nbytes > self.max_bytes):
+                _, (_, n) = self._entries.popitem(last=False)
+                self._nbytes -= n
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+
+_INT64 = struct.Struct("<q")
+_FLOAT64 = struct.Struct("<d")
+_LENGTH = struct.Struct("<Q")
 
 
 def _cache_hash(value):
     # type: (...) -> bytes
-    from _stbt.xxhash import Xxhash64
+    """Hashes a (possibly nested) value of function arguments.
+
+    Each value is fed into the hash as a type tag followed by a compact binary
+    encoding, so this is much faster than serialising the arguments to JSON
+    first. Arrays are hashed in place, without copying them.
+    """
+    global _MatchParameters
+    if _MatchParameters is None:
+        # Imported here (once) because _stbt.match imports this module:
+        from _stbt.match import MatchParameters
+        _MatchParameters = MatchParameters
     h = Xxhash64()
+    _hash_value(h, value)
+    return h.digest()
 
-    class HashWriter(object):
-        def write(self, data):
-            if isinstance(data, str):
-                data = data.encode("utf-8")
-            h.update(data)
-            return len(data)
 
-    json.dump(value, HashWriter(), cls=_ArgsEncoder, sort_keys=True)
-    return h.digest()
+_MatchParameters = None
+
+
+def _hash_value(h, o):
+    if o is None:
+        h.update(b"N")
+    elif isinstance(o, bool):
+        h.update(b"T" if o else b"F")
+    elif isinstance(o, int):
+        if -2 ** 63 <= o < 2 ** 63:
+            h.update(b"i" + _INT64.pack(o))
+        else:
+            _hash_bytes(h, b"I", str(o).encode("ascii"))
+    elif isinstance(o, float):
+        h.update(b"f" + _FLOAT64.pack(o))
+    elif isinstance(o, str):
+        _hash_bytes(h, b"s", o.encode("utf-8"))
+    elif isinstance(o, bytes):
+        _hash_bytes(h, b"b", o)
+    elif isinstance(o, (list, tuple)):
+        h.update(b"l" + _LENGTH.pack(len(o)))
+        for x in o:
+            _hash_value(h, x)
+    elif isinstance(o, dict):
+        h.update(b"d" + _LENGTH.pack(len(o)))
+        for k in sorted(o):
+            _hash_value(h, k)
+            _hash_value(h, o[k])
+    elif isinstance(o, numpy.ndarray):
+        _hash_bytes(h, b"a", o.dtype.str.encode("ascii"))
+        _hash_value(h, o.shape)
+        h.update_array(o)
+    elif isinstance(o, ImageLogger):
+        if o.enabled:
+            raise NotCachable()
+        h.update(b"N")
+    elif isinstance(o, LooseVersion):
+        _hash_bytes(h, b"s", str(o).encode("utf-8"))
+    elif isinstance(o, (set, frozenset)):
+        _hash_value(h, sorted(o))
+    elif isinstance(o, _MatchParameters):
+        _hash_value(h, {
+            "match_method": o.match_method.value,
+            "match_threshold": o.match_threshold,
+            "confirm_method": o.confirm_method.value,
+            "confirm_threshold": o.confirm_threshold,
+            "erode_passes": o.erode_passes})
+    else:
+        raise TypeError("%r is not cachable" % (o,))
+
+
+def _hash_bytes(h, tag, data):
+    h.update(tag + _LENGTH.pack(len(data)))
+    h.update(data)
 
 
 def test_that_cache_is_disabled_when_debug_match():
@@ -280,6 +984,348 @@ def _check_cache_behaviour(func):
     return cached_time, uncached_time, cached_result, uncached_result
 
 
+def test_lru_cache():
+    c = _LruCache(max_entries=3, max_bytes=100)
+    for i in range(3):
+        c.put(i, [i], 10)
+    assert c.get(0) == [0]
+    c.put(3, [3], 10)  # Evicts the least recently used entry
+    assert c.get(1) is _MISSING
+    assert [c.get(i) for i in (0, 2, 3)] == [[0], [2], [3]]
+
+    c.put(4, [4], 80)
+    assert c.get(0) is _MISSING
+    assert c.get(4) == [4]
+    c.put(5, [5], 101)  # Too big
+    assert c.get(5) is _MISSING
+
+
+def test_cache_hash():
+    import pytest
+
+    frame = numpy.random.randint(0, 256, (720, 1280, 3), dtype=numpy.uint8)
+    crop = frame[100:200, 300:500]
+    assert not crop.flags.c_contiguous
+    assert _cache_hash(crop) == _cache_hash(crop.copy())
+    assert _cache_hash(frame[:, :, 0]) == _cache_hash(frame[:, :, 0].copy())
+    assert _cache_hash(frame[::-1]) == _cache_hash(frame[::-1].copy())
+    assert _cache_hash(crop) != _cache_hash(frame[100:200, 301:501])
+    assert _cache_hash(crop) != _cache_hash(crop.reshape((200, 100, 3)))
+    assert _cache_hash(crop) != _cache_hash(crop.astype(numpy.int8))
+
+    assert (_cache_hash({"a": 1, "b": [2.0, "c"]}) ==
+            _cache_hash({"b": (2.0, "c"), "a": 1}))
+    values = [None, True, False, 0, 1, 2 ** 70, 0.0, 1.0, "", "1", b"1",
+              [], [None], ["a", "b"], ["ab"], {}, {"1": 1}]
+    assert len(set(_cache_hash(x) for x in values)) == len(values)
+
+    with pytest.raises(TypeError):
+        _cache_hash(object())
+
+
+def test_that_memoize_uses_memory_cache():
+    counter = [0]
+
+    @memoize()
+    def cached_function(arg):
+        counter[0] += 1
+        return {"arg": arg}
+
+    with named_temporary_directory() as tmpdir:
+        with cache(tmpdir):
+            assert cached_function(1) == {"arg": 1}
+            assert counter[0] == 1
+
+            # Served from memory, even if it's no longer on disk:
+            _writer.flush()
+            with _cache.begin(write=True) as txn:
+                for key, _ in list(txn.cursor()):
+                    if key != b"atime":
+                        txn.delete(key)
+            assert cached_function(1) == {"arg": 1}
+            assert counter[0] == 1
+
+        with cache(tmpdir):
+            assert cached_function(1) == {"arg": 1}
+            assert counter[0] == 2
+            assert cached_function(1) == {"arg": 1}
+            assert counter[0] == 2
+
+
+def test_that_puts_are_written_in_batches():
+    with named_temporary_directory() as tmpdir:
+        with cache(tmpdir):
+            for i in range(10):
+                _cache_put(str(i).encode(), i, "f")
+            assert [_cache_get(str(i).encode()) for i in range(10)] == \
+                list(range(10))
+        with lmdb.open(tmpdir) as db, db.begin() as txn:  # pylint: disable=no-member
+            assert [json.loads(txn.get(str(i).encode()))
+                    for i in range(10)] == list(range(10))
+
+
+def test_that_write_errors_dont_stop_later_puts_being_written():
+    # pylint:disable=protected-access
+    with named_temporary_directory() as tmpdir:
+        with cache(tmpdir):
+            writer = _writer
+            orig_write = writer._write
+            calls = []
+
+            def _write(batch, touched):
+                calls.append([key for key, _ in batch])
+                if len(calls) == 1:
+                    raise lmdb.Error("Disk on fire")  # pylint: disable=no-member
+                orig_write(batch, touched)
+
+            writer._write = _write
+            _cache_put(b"1", 1, "f")
+            # Wake the background thread, like `WRITE_BEHIND_MAX_PENDING` puts
+            # would:
+            with writer._cond:
+                writer._cond.notify()
+            for _ in range(100):
+                if calls:
+                    break
+                time.sleep(0.01)
+            assert calls == [[b"1"]]
+            assert writer._thread.is_alive()
+            assert writer.get(b"1") is None  # The failed batch was dropped
+
+            _cache_put(b"2", 2, "f")
+        assert calls == [[b"1"], [b"2"]]
+        with lmdb.open(tmpdir) as db, db.begin() as txn:  # pylint: disable=no-member
+            assert txn.get(b"1") is None
+            assert json.loads(txn.get(b"2")) == 2
+
+
+def test_that_cache_evicts_least_recently_used_entries():
+    with named_temporary_directory() as tmpdir, cache(tmpdir):
+        keys = [b"key%i" % i for i in range(10)]
+        for key in keys:
+            _cache_put(key, "x" * 100, "f")
+        _writer.flush()
+        with _cache.begin(write=True) as txn:
+            for i, key in enumerate(keys):
+                atime = 100 if i == 0 else i
+                txn.put(key, _pack_atime(atime, 106, "f"), db=_writer.atimes)
+
+        _writer.evict(300)
+        with _cache.begin() as txn:
+            assert [k for k in keys if txn.get(k) is None] == keys[1:4]
+            assert [k for k in keys if txn.get(k, db=_writer.atimes) is None] \
+                == keys[1:4]
+
+
+def test_that_full_cache_keeps_working():
+    with named_temporary_directory() as tmpdir, \
+            cache(tmpdir, max_size_bytes=1024 * 1024):
+        for i in range(500):
+            _cache_put(b"key%i" % i, "x" * 10000, "f")
+            _writer.flush()
+        assert not _cache_full_warning
+        with _cache.begin() as txn:
+            assert txn.get(b"key0") is None
+            assert txn.get(b"key499") is not None
+
+
+def test_cache_stats():
+    @memoize()
+    def cached_function(arg):
+        return arg
+
+    @memoize_iterator()
+    def cached_iterator(arg):
+        for x in range(arg):
+            yield x
+
+    name = _function_name(cached_function)
+    iterator_name = _function_name(cached_iterator)
+    reset_stats()
+    cached_function(0)  # Cache not enabled: Not counted
+    with named_temporary_directory() as tmpdir:
+        with cache(tmpdir):
+            for _ in range(3):
+                cached_function(1)
+            imglog = ImageLogger("test")
+            imglog.enabled = True  # Debug images can't be cached
+            cached_function(imglog)
+            for _ in range(2):
+                assert list(cached_iterator(2)) == [0, 1]
+        s = stats()
+        assert list(s.keys()) == [name, iterator_name]
+        assert (s[name].hits, s[name].misses, s[name].uncachable) == (2, 1, 1)
+        assert s[name].stored_bytes == len(b"1") + 8
+        assert (s[iterator_name].hits, s[iterator_name].misses) == (3, 3)
+        assert "cached_iterator" in format_stats()
+
+        fs = file_stats(tmpdir)
+        assert fs["functions"] == {
+            name: {"entries": 1, "bytes": s[name].stored_bytes,
+                   "last_used": fs["functions"][name]["last_used"]},
+            iterator_name: {
+                "entries": 3, "bytes": s[iterator_name].stored_bytes,
+                "last_used": fs["functions"][iterator_name]["last_used"]}}
+        assert fs["functions"][name]["last_used"] > 0
+        assert 0 < fs["used_bytes"] <= fs["map_size"]
+
+    reset_stats()
+    assert stats() == {}
+    assert format_stats() == ""
+
+
+def test_that_evicting_processes_dont_all_evict():
+    with named_temporary_directory() as tmpdir, cache(tmpdir):
+        keys = [b"key%i" % i for i in range(10)]
+        for key in keys:
+            _cache_put(key, "x" * 100, "f")
+        _writer.flush()
+
+        failed_at = time.time()
+        _writer.evict(300, unless_evicted_since=failed_at)
+        # Another process found that the cache was full at the same time:
+        _writer.evict(300, unless_evicted_since=failed_at)
+        with _cache.begin() as txn:
+            assert len([k for k in keys if txn.get(k) is not None]) == 7
+
+
+def _shared_cache_worker(filename, n):
+    @memoize()
+    def shared_function(arg):
+        return arg
+
+    with cache(filename, shared=True):
+        for i in range(100):
+            shared_function(i % (n + 1))
+    s = stats()[_function_name(shared_function)]
+    sys.exit(0 if s.misses + s.hits == 100 else 1)
+
+
+def test_shared_cache():
+    import multiprocessing
+
+    with named_temporary_directory() as tmpdir:
+        workers = [
+            multiprocessing.Process(target=_shared_cache_worker,
+                                    args=(tmpdir, n))
+            for n in range(8)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+            assert w.exitcode == 0
+
+        fs = file_stats(tmpdir)
+        assert sum(f["entries"] for f in fs["functions"].values()) == 8
+
+        # Results from the other processes are available:
+        @memoize()
+        def shared_function(arg):  # pylint:disable=unused-argument
+            assert False, "Should have been cached"
+
+        with cache(tmpdir, shared=True):
+            assert [shared_function(i) for i in range(8)] == list(range(8))
+
+
+def test_serializers():
+    from _stbt.imgutils import Frame
+    from _stbt.match import MatchResult, Position
+    from _stbt.ocr import TextMatchResult
+    from _stbt.types import Region
+
+    a = numpy.arange(24, dtype=numpy.uint16).reshape((2, 4, 3))
+    frame = Frame(numpy.zeros((4, 6, 3), dtype=numpy.uint8), time=1234.5)
+    s = _get_serializer("numpy")
+    out = s.loads(s.dumps(a[:, 1:]))
+    assert out.dtype == a.dtype and (out == a[:, 1:]).all()
+    assert not out.flags.writeable
+
+    s = _get_serializer("stbt")
+    value = {
+        "array": a[:, ::2],
+        "list": [1, "a", None, Region.ALL],
+        "match": MatchResult(
+            time=1234.5, match=True, region=Region(1, 2, width=3, height=4),
+            first_pass_result=0.99, frame=frame, image="reference.png"),
+        "text": TextMatchResult(1234.5, False, None, frame, "hello"),
+        "position": Position(1, 2),
+    }
+    out = s.loads(s.dumps(value))
+    assert (out["array"] == a[:, ::2]).all()
+    assert out["list"] == [1, "a", None, Region.ALL]
+    assert isinstance(out["list"][3], Region)
+    assert isinstance(out["position"], Position)
+    m = out["match"]
+    assert isinstance(m, MatchResult)
+    assert m.match and m.region == Region(1, 2, width=3, height=4)
+    assert m.image == "reference.png"
+    assert isinstance(m.frame, Frame) and m.frame.time == 1234.5
+    assert (m.frame == frame).all() and m.frame.shape == frame.shape
+    t = out["text"]
+    assert isinstance(t, TextMatchResult) and t.text == "hello"
+    assert t.region is None and t.frame.time == 1234.5
+
+    import pytest
+    with pytest.raises(ValueError):
+        memoize(serializer="pickle")
+
+
+def test_memoize_with_serializer():
+    from _stbt.types import Region
+    counter = [0]
+
+    @memoize(serializer="stbt")
+    def find_thing(frame):
+        counter[0] += 1
+        return Region(0, 0, frame.shape[1], frame.shape[0]), frame[:1]
+
+    frame = numpy.zeros((10, 20, 3), dtype=numpy.uint8)
+    with named_temporary_directory() as tmpdir:
+        for _ in range(2):
+            with cache(tmpdir):
+                region, row = find_thing(frame)
+                assert region == Region(0, 0, 20, 10)
+                assert row.shape == (1, 20, 3)
+        assert counter[0] == 1
+
+
+def test_that_stbt_run_caches_memoized_functions_if_configured(monkeypatch):
+    from _stbt.config import _config_init, set_config
+    from _stbt.stbt_run import image_processing_cache
+    counter = [0]
+
+    @memoize()
+    def cached_function(arg):
+        counter[0] += 1
+        return arg
+
+    name = _function_name(cached_function)
+    with named_temporary_directory() as tmpdir:
+        monkeypatch.setenv("XDG_CACHE_HOME", tmpdir)
+        monkeypatch.setenv("STBT_CONFIG_FILE", "%s/stbt.conf:%s" % (
+            tmpdir, os.environ.get("STBT_CONFIG_FILE", "")))
+        try:
+            _config_init(force=True)
+            reset_stats()
+            for _ in range(2):
+                with image_processing_cache():
+                    assert cached_function(1) == 1
+            assert counter[0] == 2  # Not enabled by default
+            assert stats() == {}
+
+            set_config("cache", "stbt_run", "true")
+            for _ in range(2):
+                with image_processing_cache():
+                    assert cached_function(1) == 1
+            assert counter[0] == 3
+            assert (stats()[name].hits, stats()[name].misses) == (1, 1)
+            assert os.path.exists(tmpdir + "/stbt/cache.lmdb")
+        finally:
+            monkeypatch.undo()
+            _config_init(force=True)
+            reset_stats()
+
+
 def test_memoize_iterator():
     counter = [0]
 
@@ -371,10 +1417,14 @@ def test_that_cache_speeds_up_match_all():
 def test_that_cache_speeds_up_ocr():
     import stbt
     import cv2
+    import _stbt.ocr
 
     frame = cv2.imread('tests/red-black.png')
 
     def ocr():
+        # Don't let OCR's memory of the last result for each region hide the
+        # difference:
+        _stbt.ocr._last_results.clear()  # pylint:disable=protected-access
         return stbt.ocr(frame=frame)
 
     cached_time, uncached_time, cached_result, uncached_result = (
@@ -389,10 +1439,12 @@ def test_that_cache_speeds_up_ocr():
 def test_that_cache_speeds_up_match_text():
     import stbt
     import cv2
+    import _stbt.ocr
 
     frame = cv2.imread('tests/red-black.png')
 
     def match_text():
+        _stbt.ocr._last_results.clear()  # pylint:disable=protected-access
         return stbt.match_text("RED", frame=frame)
 
     cached_time, uncached_time, cached_result, uncached_result = (
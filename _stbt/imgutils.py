@@ -7,7 +7,10 @@ from future.utils import text_to_native_str
 
 import inspect
 import os
-from collections import namedtuple
+import threading
+import weakref
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 
 import cv2
 import numpy
@@ -54,6 +57,146 @@ class Frame(numpy.ndarray):
             dimensions)
 
 
+class _DerivedImages(object):
+    """A bounded cache of images calculated from a video-frame, such as its
+    grayscale conversion or its downsampled "pyramid".
+
+    Functions like `match`, `ocr`, `is_screen_black` and `detect_motion` often
+    run on the same frame (for example in a `FrameObject`), and each of them
+    would otherwise repeat the same conversions.
+
+    Entries are keyed by the identity of the frame's underlying memory, the
+    region of the frame (a cropped view of a frame has a different key to the
+    full frame) and the name & arguments of the calculation. Entries are
+    discarded when the frame is garbage-collected, and the least recently used
+    entries are discarded when the cache grows beyond ``max_entries`` or
+    ``max_bytes``.
+
+    Results are only cached for read-only frames (like those returned by
+    `stbt.get_frame` and `stbt.frames`) because anyone could modify a writeable
+    frame after we've cached something derived from it -- unless the caller
+    uses `shared`, promising not to modify the frame until the end of the
+    ``with`` block. `shared` only applies to the calling thread.
+
+    The cached images are marked read-only, so you must copy them before
+    modifying them.
+    """
+    def __init__(self, max_entries=64, max_bytes=128 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()  # (id(owner), key) -> (value, nbytes)
+        self._owners = {}  # id(owner) -> weakref
+        self._nbytes = 0
+        # The `shared` state of each thread: `depth` (how many `shared` blocks
+        # it is in) and `owners` (the writeable frames it has cached results
+        # for).
+        self._local = threading.local()
+
+    def _shared_depth(self):
+        return getattr(self._local, "depth", 0)
+
+    def enabled_for(self, image):
+        owner = _owner(image)
+        return not owner.flags.writeable or self._shared_depth() > 0
+
+    def get(self, image, name, func, *args):
+        """Returns ``func(image, *args)``, re-using the previous result if it
+        has been calculated before for the same ``image``.
+
+        ``name`` identifies the calculation (it's part of the key, instead of
+        ``func``, so that different callers can share results).
+        """
+        owner = _owner(image)
+        if owner.flags.writeable and self._shared_depth() == 0:
+            return func(image, *args)
+
+        key = (id(owner), (name, args, image.__array_interface__["data"][0],
+                           image.shape, image.strides, image.dtype.str))
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry  # Most recently used goes last
+                return entry[0]
+
+        value = func(image, *args)
+        arrays = list(_iter_arrays(value))
+        for x in arrays:
+            if _owner(x) is not owner:
+                x.flags.writeable = False
+        nbytes = sum(x.nbytes for x in arrays)
+        if nbytes > self.max_bytes:
+            return value
+
+        with self._lock:
+            if id(owner) not in self._owners:
+                self._owners[id(owner)] = weakref.ref(
+                    owner, self._make_finalizer(id(owner)))
+            if owner.flags.writeable:
+                self._local.owners.add(id(owner))
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[1]
+            self._entries[key] = (value, nbytes)
+            self._nbytes += nbytes
+            while (len(self._entries) > self.max_entries or
+                   self._nbytes > self.max_bytes):
+                _, (_, n) = self._entries.popitem(last=False)
+                self._nbytes -= n
+        return value
+
+    @contextmanager
+    def shared(self):
+        """Cache images derived from writeable frames too, until the end of
+        the ``with`` block. The frames mustn't be modified until then.
+        """
+        local = self._local
+        if self._shared_depth() == 0:
+            local.owners = set()
+        local.depth = self._shared_depth() + 1
+        try:
+            yield
+        finally:
+            local.depth -= 1
+            if local.depth == 0:
+                with self._lock:
+                    for owner_id in local.owners:
+                        self._discard(owner_id)
+                local.owners = set()
+
+    def _make_finalizer(self, owner_id):
+        def finalizer(_):
+            with self._lock:
+                self._discard(owner_id)
+        return finalizer
+
+    def _discard(self, owner_id):
+        self._owners.pop(owner_id, None)
+        for key in [k for k in self._entries if k[0] == owner_id]:
+            _, n = self._entries.pop(key)
+            self._nbytes -= n
+
+
+def _iter_arrays(value):
+    """The numpy arrays in ``value``, which may be a (nested) list or tuple."""
+    if isinstance(value, (list, tuple)):
+        for x in value:
+            for y in _iter_arrays(x):
+                yield y
+    elif isinstance(value, numpy.ndarray):
+        yield value
+
+
+def _owner(image):
+    """The array that owns the memory of ``image`` (which may be a view)."""
+    while isinstance(image.base, numpy.ndarray):
+        image = image.base
+    return image
+
+
+_derived_images = _DerivedImages()
+
+
 def _frame_repr(frame):
     if frame is None:
         return "None"
@@ -111,6 +254,11 @@ class _ImageFromUser(namedtuple(
 
 
 def _load_image(image, flags=None):
+    """Loads a reference image given by the user to functions like `match`.
+
+    Images loaded from disk are cached (see `_imread_cached`), so the numpy
+    array in the returned ``_ImageFromUser`` is read-only.
+    """
     if isinstance(image, _ImageFromUser):
         return image
     if isinstance(image, numpy.ndarray):
@@ -120,13 +268,106 @@ def _load_image(image, flags=None):
         absolute_filename = find_user_file(relative_filename)
         if not absolute_filename:
             raise IOError("No such file: %s" % relative_filename)
-        numpy_image = imread(absolute_filename, flags)
+        numpy_image = _imread_cached(absolute_filename, flags)
         if numpy_image is None:
             raise IOError("Failed to load image: %s" %
                           absolute_filename)
         return _ImageFromUser(numpy_image, relative_filename, absolute_filename)
 
 
+MAX_DECODED_IMAGES = 256
+MAX_DECODED_IMAGES_BYTES = 256 * 1024 * 1024
+_decoded_images = OrderedDict()  # key -> (image, nbytes)
+_decoded_images_nbytes = 0
+_decoded_images_lock = threading.Lock()
+
+
+def _imread_cached(filename, flags=None):
+    """Like `imread`, but caches the decoded images in memory (and optionally
+    on disk, if ``disk_cache`` is enabled in the ``[load_image]`` section of
+    the stbt config file).
+
+    Test-packs with many reference images spend a lot of time decoding the
+    same PNG files over and over again. The cache key includes the file's
+    modification time & size, so changes to the file are picked up.
+
+    The returned array is read-only, because it is shared with other callers.
+    """
+    global _decoded_images_nbytes
+
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return imread(filename, flags)
+    key = (filename, flags, st.st_mtime, st.st_size)
+
+    with _decoded_images_lock:
+        entry = _decoded_images.pop(key, None)
+        if entry is not None:
+            _decoded_images[key] = entry  # Most recently used goes last
+            return entry[0]
+
+    img = _imread_disk_cached(key, _image_cache_dir())
+    if img is None:
+        return None
+    img.flags.writeable = False
+
+    if img.nbytes <= MAX_DECODED_IMAGES_BYTES:
+        with _decoded_images_lock:
+            old = _decoded_images.pop(key, None)
+            if old is not None:
+                _decoded_images_nbytes -= old[1]
+            _decoded_images[key] = (img, img.nbytes)
+            _decoded_images_nbytes += img.nbytes
+            while (len(_decoded_images) > MAX_DECODED_IMAGES or
+                   _decoded_images_nbytes > MAX_DECODED_IMAGES_BYTES):
+                _, (_, nbytes) = _decoded_images.popitem(last=False)
+                _decoded_images_nbytes -= nbytes
+    return img
+
+
+def _image_cache_dir():
+    from .config import get_config
+    if not get_config("load_image", "disk_cache", False, type_=bool):
+        return None
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or
+        os.path.join(os.environ["HOME"], ".cache"),
+        "stbt", "images")
+
+
+def _imread_disk_cached(key, cache_dir):
+    import hashlib
+    from .utils import mkdir_p
+
+    filename, flags = key[:2]
+    if cache_dir is None:
+        return imread(filename, flags)
+
+    cache_file = os.path.join(
+        cache_dir,
+        hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".npy")
+
+    try:
+        return numpy.load(cache_file)
+    except (IOError, OSError, ValueError):
+        pass
+
+    img = imread(filename, flags)
+    if img is not None:
+        try:
+            mkdir_p(cache_dir)
+            # Write to a temporary file & rename so that concurrent `stbt run`
+            # processes never see a partially-written file.
+            tmp = "%s.%d.tmp" % (cache_file, os.getpid())
+            with open(tmp, "wb") as f:
+                numpy.save(f, img)
+            os.rename(tmp, cache_file)
+        except (IOError, OSError) as e:
+            warn("Failed to write image cache file %s: %s" % (cache_file, e))
+    return img
+
+
 def imread(filename, flags=None):
     if flags is None:
         cv2_flags = cv2.IMREAD_UNCHANGED
@@ -289,3 +530,146 @@ def limit_time(frames, duration_secs):
             break
         else:
             yield frame
+
+
+def test_derived_images_are_cached_for_read_only_frames():
+    cache = _DerivedImages()
+    calls = []
+
+    def gray(image):
+        calls.append(image.shape)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    frame = Frame(numpy.zeros((720, 1280, 3), dtype=numpy.uint8), time=1)
+    a = cache.get(frame, "gray", gray)
+    b = cache.get(frame, "gray", gray)
+    assert len(calls) == 2  # Writeable frame: Not cached
+
+    # Like the frames from `stbt.get_frame`:
+    array = numpy.zeros((720, 1280, 3), dtype=numpy.uint8)
+    array.flags.writeable = False
+    frame = Frame(array, time=1)
+    del array
+    a = cache.get(frame, "gray", gray)
+    b = cache.get(frame, "gray", gray)
+    assert len(calls) == 3
+    assert a is b
+    assert not a.flags.writeable
+
+    # Different regions of the same frame are cached separately:
+    r = Region(10, 10, width=100, height=100)
+    c = cache.get(crop(frame, r), "gray", gray)
+    d = cache.get(crop(frame, r), "gray", gray)
+    assert len(calls) == 4
+    assert c is d
+    assert c.shape == (100, 100)
+
+    # Entries are discarded when the frame is garbage-collected:
+    assert len(cache._entries) == 2  # pylint:disable=protected-access
+    del frame
+    assert len(cache._entries) == 0  # pylint:disable=protected-access
+
+
+def test_derived_images_shared():
+    cache = _DerivedImages()
+    calls = []
+
+    def gray(image):
+        calls.append(image.shape)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    frame = numpy.zeros((720, 1280, 3), dtype=numpy.uint8)
+    with cache.shared():
+        a = cache.get(frame, "gray", gray)
+        b = cache.get(frame, "gray", gray)
+        assert a is b
+        assert len(calls) == 1
+    assert len(cache._entries) == 0  # pylint:disable=protected-access
+    cache.get(frame, "gray", gray)
+    assert len(calls) == 2
+
+
+def test_derived_images_shared_only_applies_to_the_calling_thread():
+    cache = _DerivedImages()
+    calls = []
+
+    def gray(image):
+        calls.append(image.shape)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    frame = numpy.zeros((720, 1280, 3), dtype=numpy.uint8)
+    entered = threading.Event()
+    done = threading.Event()
+
+    def other_thread():
+        with cache.shared():
+            entered.set()
+            done.wait(10)
+
+    t = threading.Thread(target=other_thread)
+    t.start()
+    try:
+        assert entered.wait(10)
+        assert not cache.enabled_for(frame)
+        cache.get(frame, "gray", gray)
+        cache.get(frame, "gray", gray)
+        assert len(calls) == 2  # Not cached
+        assert len(cache._entries) == 0  # pylint:disable=protected-access
+    finally:
+        done.set()
+        t.join()
+
+
+def test_derived_images_are_bounded():
+    cache = _DerivedImages(max_entries=3, max_bytes=1000)
+    frame = numpy.zeros((10, 10, 3), dtype=numpy.uint8)
+    frame.flags.writeable = False
+    for n in range(5):
+        cache.get(frame, "copy%d" % n, numpy.copy)
+    assert len(cache._entries) == 3  # pylint:disable=protected-access
+    assert cache._nbytes == 900  # pylint:disable=protected-access
+    cache.get(frame, "copy5", numpy.copy)
+    assert len(cache._entries) == 3  # pylint:disable=protected-access
+
+    big = numpy.zeros((20, 20, 3), dtype=numpy.uint8)
+    big.flags.writeable = False
+    cache.get(big, "copy", numpy.copy)  # Too big to cache
+    assert len(cache._entries) == 3  # pylint:disable=protected-access
+
+
+def test_that_imread_cached_reuses_decoded_images():
+    import time
+    from .utils import named_temporary_directory
+
+    with named_temporary_directory() as d:
+        filename = os.path.join(d, "image.png")
+        cv2.imwrite(filename, numpy.zeros((10, 10, 3), dtype=numpy.uint8))
+        a = _imread_cached(filename)
+        assert not a.flags.writeable
+        assert _imread_cached(filename) is a
+
+        # Picks up changes to the file:
+        time.sleep(0.01)
+        cv2.imwrite(filename, numpy.ones((10, 10, 3), dtype=numpy.uint8))
+        os.utime(filename, (time.time() + 1, time.time() + 1))
+        b = _imread_cached(filename)
+        assert b is not a
+        assert b.max() == 1
+
+
+def test_imread_disk_cache():
+    from .utils import named_temporary_directory
+
+    with named_temporary_directory() as d:
+        filename = os.path.join(d, "image.png")
+        img = numpy.random.randint(0, 256, (10, 10, 4), dtype=numpy.uint8)
+        cv2.imwrite(filename, img)
+        key = (filename, None, os.stat(filename).st_mtime, 400)
+        cache_dir = os.path.join(d, "cache")
+
+        a = _imread_disk_cached(key, cache_dir)
+        assert len(os.listdir(cache_dir)) == 1
+        os.remove(filename)  # So it must come from the cache
+        b = _imread_disk_cached(key, cache_dir)
+        assert b.shape == (10, 10, 4)
+        assert (a == b).all()
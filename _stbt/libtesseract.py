@@ -0,0 +1,220 @@
+"""
+A ctypes wrapper around tesseract's C API (libtesseract).  Loading tesseract's
+language models takes much longer than recognising the text in a typical
+`stbt.ocr` region (especially with the LSTM engine), so we keep initialised
+instances around and give them images directly from memory, instead of
+starting a new ``tesseract`` process for every call.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from builtins import *  # pylint:disable=redefined-builtin,unused-wildcard-import,wildcard-import,wrong-import-order
+import ctypes
+import ctypes.util
+import locale
+import threading
+from contextlib import contextmanager
+
+import numpy
+
+_lib = None
+_lib_loaded = False
+_lib_lock = threading.Lock()
+
+# TessOcrEngineMode
+OEM_DEFAULT = 3
+
+
+def _load():
+    name = ctypes.util.find_library("tesseract")
+    if name is None:
+        return None
+    try:
+        lib = ctypes.CDLL(name)
+    except OSError:
+        return None
+
+    # const char* TessVersion();
+    lib.TessVersion.argtypes = []
+    lib.TessVersion.restype = ctypes.c_char_p
+
+    # TessBaseAPI* TessBaseAPICreate();
+    lib.TessBaseAPICreate.argtypes = []
+    lib.TessBaseAPICreate.restype = ctypes.c_void_p
+
+    # void TessBaseAPIDelete(TessBaseAPI* handle);
+    lib.TessBaseAPIDelete.argtypes = [ctypes.c_void_p]
+    lib.TessBaseAPIDelete.restype = None
+
+    # int TessBaseAPIInit1(TessBaseAPI* handle, const char* datapath,
+    #                      const char* language, TessOcrEngineMode oem,
+    #                      char** configs, int configs_size);
+    lib.TessBaseAPIInit1.argtypes = [
+        ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int,
+        ctypes.POINTER(ctypes.c_char_p), ctypes.c_int]
+    lib.TessBaseAPIInit1.restype = ctypes.c_int
+
+    # void TessBaseAPISetPageSegMode(TessBaseAPI* handle, TessPageSegMode mode);
+    lib.TessBaseAPISetPageSegMode.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.TessBaseAPISetPageSegMode.restype = None
+
+    # void TessBaseAPISetImage(TessBaseAPI* handle,
+    #                          const unsigned char* imagedata, int width,
+    #                          int height, int bytes_per_pixel,
+    #                          int bytes_per_line);
+    lib.TessBaseAPISetImage.argtypes = [
+        ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_int,
+        ctypes.c_int, ctypes.c_int]
+    lib.TessBaseAPISetImage.restype = None
+
+    # int TessBaseAPIRecognize(TessBaseAPI* handle, ETEXT_DESC* monitor);
+    lib.TessBaseAPIRecognize.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    lib.TessBaseAPIRecognize.restype = ctypes.c_int
+
+    # char* TessBaseAPIGetUTF8Text(TessBaseAPI* handle);
+    lib.TessBaseAPIGetUTF8Text.argtypes = [ctypes.c_void_p]
+    lib.TessBaseAPIGetUTF8Text.restype = ctypes.c_void_p
+
+    # char* TessBaseAPIGetHOCRText(TessBaseAPI* handle, int page_number);
+    lib.TessBaseAPIGetHOCRText.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.TessBaseAPIGetHOCRText.restype = ctypes.c_void_p
+
+    # void TessDeleteText(const char* text);
+    lib.TessDeleteText.argtypes = [ctypes.c_void_p]
+    lib.TessDeleteText.restype = None
+
+    # void TessBaseAPIClear(TessBaseAPI* handle);
+    lib.TessBaseAPIClear.argtypes = [ctypes.c_void_p]
+    lib.TessBaseAPIClear.restype = None
+
+    # void TessBaseAPIEnd(TessBaseAPI* handle);
+    lib.TessBaseAPIEnd.argtypes = [ctypes.c_void_p]
+    lib.TessBaseAPIEnd.restype = None
+
+    return lib
+
+
+def _get_lib():
+    global _lib, _lib_loaded
+    with _lib_lock:
+        if not _lib_loaded:
+            _lib = _load()
+            _lib_loaded = True
+        return _lib
+
+
+# Held by anything that changes the process's locale. The locale is shared by
+# all threads, so setting it isn't thread-safe.
+_locale_lock = threading.Lock()
+
+
+@contextmanager
+def _c_locale():
+    """Sets the locale to "C" for the duration of the ``with`` block.
+
+    Tesseract 4.0 aborts the process if the locale isn't "C" when it is
+    created, and it parses the numbers in its config files with the current
+    locale while it's being initialised.
+    """
+    with _locale_lock:
+        old_locale = locale.setlocale(locale.LC_ALL)
+        if old_locale == "C":
+            yield
+            return
+        locale.setlocale(locale.LC_ALL, "C")
+        try:
+            yield
+        finally:
+            locale.setlocale(locale.LC_ALL, old_locale)
+
+
+def version():
+    """The version of libtesseract (e.g. "4.0.0"), or None if it isn't
+    installed."""
+    lib = _get_lib()
+    if lib is None:
+        return None
+    return lib.TessVersion().decode("utf-8")
+
+
+class TessBaseAPI(object):
+    """An initialised instance of tesseract.
+
+    Not thread-safe: Use each instance from one thread at a time.
+
+    :param str datapath: The directory containing "tessdata" (tesseract 3) or
+        the tessdata directory itself (tesseract 4), like the
+        ``TESSDATA_PREFIX`` environment variable. If None, tesseract uses
+        ``TESSDATA_PREFIX`` or its default location.
+    :param str lang: Language(s), like tesseract's ``-l`` argument.
+    :param int oem: OCR engine mode, like tesseract's ``--oem`` argument.
+    :param configs: Names of config files in tessdata/configs, like the
+        ``configfile`` arguments to the tesseract command-line tool.
+    """
+    def __init__(self, datapath, lang, oem, configs=()):
+        lib = _get_lib()
+        if lib is None:
+            raise RuntimeError("libtesseract isn't installed")
+        self._lib = lib
+        self._handle = None
+
+        configs = [c.encode("utf-8") for c in configs]
+        c_configs = (ctypes.c_char_p * max(len(configs), 1))(*configs)
+        with _c_locale():
+            self._handle = lib.TessBaseAPICreate()
+            ok = lib.TessBaseAPIInit1(
+                self._handle,
+                datapath.encode("utf-8") if datapath else None,
+                lang.encode("utf-8"), oem, c_configs, len(configs)) == 0
+        if not ok:
+            self.close()
+            raise RuntimeError(
+                "Failed to initialise tesseract with lang=%r, oem=%r"
+                % (lang, oem))
+
+    def recognize(self, image, mode, hocr=False):
+        """Returns the text in `image` (a greyscale or RGB numpy array), or the
+        hOCR ``<div class="ocr_page">`` element if `hocr` is True.
+
+        :param int mode: Page segmentation mode, like tesseract's ``--psm``
+            argument.
+        """
+        image = numpy.ascontiguousarray(image, dtype=numpy.uint8)
+        if image.ndim == 2:
+            bytes_per_pixel = 1
+        elif image.ndim == 3 and image.shape[2] == 3:
+            bytes_per_pixel = 3
+        else:
+            raise ValueError("Unsupported image shape %r" % (image.shape,))
+        height, width = image.shape[:2]
+
+        lib = self._lib
+        try:
+            lib.TessBaseAPISetPageSegMode(self._handle, int(mode))
+            lib.TessBaseAPISetImage(
+                self._handle, image.ctypes.data, width, height,
+                bytes_per_pixel, image.strides[0])
+            if lib.TessBaseAPIRecognize(self._handle, None) != 0:
+                raise RuntimeError("Tesseract failed to recognise the image")
+            if hocr:
+                text = lib.TessBaseAPIGetHOCRText(self._handle, 0)
+            else:
+                text = lib.TessBaseAPIGetUTF8Text(self._handle)
+            if not text:
+                return u""
+            try:
+                return ctypes.string_at(text).decode("utf-8")
+            finally:
+                lib.TessDeleteText(text)
+        finally:
+            lib.TessBaseAPIClear(self._handle)
+
+    def close(self):
+        if self._handle is not None:
+            self._lib.TessBaseAPIEnd(self._handle)
+            self._lib.TessBaseAPIDelete(self._handle)
+            self._handle = None
+
+    def __del__(self):
+        self.close()
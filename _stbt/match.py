@@ -15,7 +15,9 @@ from builtins import *  # pylint:disable=redefined-builtin,unused-wildcard-impor
 
 import enum
 import itertools
-from collections import namedtuple
+import multiprocessing
+import threading
+from collections import deque, namedtuple
 
 import cv2
 import numpy
@@ -23,7 +25,8 @@ import numpy
 from . import cv2_compat
 from .config import ConfigurationError, get_config
 from .imgproc_cache import memoize_iterator
-from .imgutils import _frame_repr, _image_region, _load_image, crop, limit_time
+from .imgutils import (_derived_images, _DerivedImages, _frame_repr,
+                       _image_region, _load_image, crop, limit_time)
 from .logging import ddebug, debug, draw_on, get_debug_level, ImageLogger
 from .sqdiff import sqdiff
 from .types import Region, UITestFailure
@@ -274,7 +277,12 @@ def match(image, frame=None, match_parameters=None, region=Region.ALL):
     Added in v30: Support transparency in the reference image, and new match
     method ``MatchMethod.SQDIFF``.
     """
-    result = next(_match_all(image, frame, match_parameters, region))
+    return _match(image, frame, match_parameters, region)
+
+
+def _match(image, frame, match_parameters, region, early_exit=False):
+    result = next(_match_all(image, frame, match_parameters, region,
+                             early_exit))
     if result.match:
         debug("Match found: %s" % str(result))
     else:
@@ -316,10 +324,51 @@ def match_all(image, frame=None, match_parameters=None, region=Region.ALL):
             break
 
 
-def _match_all(image, frame, match_parameters, region):
+def match_many(images, frame=None, match_parameters=None, region=Region.ALL):
+    """
+    Search for several images in a single video frame.
+
+    This is equivalent to calling `match` once for each image, but it is faster
+    because the work that depends only on the video frame (such as building the
+    downsampled "pyramid" of the frame that is used by the first pass of the
+    image-matching algorithm) is done once and shared by all of the reference
+    images.
+
+    :type images: list of string or `numpy.ndarray`
+    :param images: The images to search for. See `match`.
+
+    :param frame: See `match`.
+    :param match_parameters: See `match`.
+    :param region: See `match`.
+
+    :returns:
+      A list of `MatchResult` objects, one for each image in ``images`` (in the
+      same order).
+
+    Example:
+
+    .. code-block:: python
+
+        guide, search, settings = stbt.match_many(
+            ["guide.png", "search.png", "settings.png"])
+    """
+    if frame is None:
+        import stbt
+        frame = stbt.get_frame()
+
+    with _derived_images.shared():
+        return [match(image, frame, match_parameters, region)
+                for image in images]
+
+
+def _match_all(image, frame, match_parameters, region, early_exit=False):
     """
     Generator that yields a sequence of zero or more truthy MatchResults,
     followed by a falsey MatchResult.
+
+    If `early_exit` is true, the `first_pass_result` of the falsey MatchResult
+    may be inaccurate (see `_find_candidate_matches`). Use it when you're going
+    to discard a falsey result.
     """
     if match_parameters is None:
         match_parameters = MatchParameters()
@@ -360,7 +409,7 @@ def _match_all(image, frame, match_parameters, region):
     if any(t.shape[x] < 1 for x in (0, 1)):
         raise ValueError("Reference image %r must contain some data"
                          % (t.shape,))
-    if (frame.shape[2], t.shape[2]) not in [(1, 1), (3, 3), (3, 4)]:
+    if (frame.shape[2], t.shape[2]) not in [(1, 1), (3, 1), (3, 3), (3, 4)]:
         raise ValueError(
             "Frame %r and reference image %r must have the same number of "
             "channels" % (frame.shape, t.shape))
@@ -399,7 +448,8 @@ def _match_all(image, frame, match_parameters, region):
     try:
         for (matched, match_region, first_pass_matched,
              first_pass_certainty) in _find_matches(
-                crop(frame, input_region), t, match_parameters, imglog):
+                crop(frame, input_region), t, match_parameters, imglog,
+                early_exit):
 
             match_region = Region.from_extents(*match_region) \
                                  .translate(input_region.x, input_region.y)
@@ -459,9 +509,9 @@ def wait_for_match(image, timeout_secs=10, consecutive_matches=1,
     last_pos = Position(0, 0)
     image = _load_image(image)
     debug("Searching for " + image.friendly_name)
+    res = None
     for frame in frames:
-        res = match(image, match_parameters=match_parameters,
-                    region=region, frame=frame)
+        res = _match_near(image, frame, match_parameters, region, res)
         if res.match and (match_count == 0 or res.position == last_pos):
             match_count += 1
         else:
@@ -474,13 +524,94 @@ def wait_for_match(image, timeout_secs=10, consecutive_matches=1,
     raise MatchTimeout(res.frame, image.friendly_name, timeout_secs)  # pylint:disable=undefined-loop-variable
 
 
+def _match_near(image, frame, match_parameters, region, last_result):
+    """Like `match`, but checks the position of `last_result` first.
+
+    When we're waiting for consecutive matches (for example for a moving
+    selection to stop moving) the match is usually at the same position as in
+    the previous frame. Checking just that position uses `match`'s fast path
+    for a reference image that is the same size as the search region, so we
+    only need the full search when the image has moved or disappeared.
+
+    `wait_for_match` only returns truthy results, so this uses `early_exit`
+    (see `_match_all`).
+    """
+    if last_result is not None and last_result.match:
+        res = _match(image, frame, match_parameters, last_result.region,
+                     early_exit=True)
+        if res.match:
+            return res
+    return _match(image, frame, match_parameters, region, early_exit=True)
+
+
+def wait_for_match_many(images, timeout_secs=10, consecutive_matches=1,
+                        match_parameters=None, region=Region.ALL,
+                        frames=None):
+    """Search for any of several images in the device-under-test's video
+    stream.
+
+    This is like `wait_for_match`, but it searches for all of ``images`` in
+    each frame (using `match_many`) and returns as soon as any of them is
+    found.
+
+    :type images: list of string or `numpy.ndarray`
+    :param images: The images to search for. See `match`.
+
+    :param timeout_secs: See `wait_for_match`.
+    :param consecutive_matches: See `wait_for_match`. Each image is counted
+        separately.
+    :param match_parameters: See `match`.
+    :param region: See `match`.
+    :param frames: See `wait_for_match`.
+
+    :returns: A list of `MatchResult` objects from the video frame where the
+        first match was found, one for each image in ``images`` (in the same
+        order). At least one of the results will be a match.
+    :raises: `MatchTimeout` if none of the images are found after
+        ``timeout_secs`` seconds.
+    """
+    if match_parameters is None:
+        match_parameters = MatchParameters()
+
+    if frames is None:
+        import stbt
+        frames = stbt.frames(timeout_secs=timeout_secs)
+    else:
+        frames = limit_time(frames, timeout_secs)
+
+    images = [_load_image(image) for image in images]
+    names = ", ".join(image.friendly_name for image in images)
+    match_counts = [0] * len(images)
+    last_positions = [Position(0, 0)] * len(images)
+    debug("Searching for any of " + names)
+    for frame in frames:
+        results = match_many(images, match_parameters=match_parameters,
+                             region=region, frame=frame)
+        for i, res in enumerate(results):
+            if res.match and (match_counts[i] == 0 or
+                              res.position == last_positions[i]):
+                match_counts[i] += 1
+            else:
+                match_counts[i] = 0
+            last_positions[i] = res.position
+        if consecutive_matches in match_counts:
+            debug("Matched " + ", ".join(
+                image.friendly_name
+                for image, count in zip(images, match_counts)
+                if count == consecutive_matches))
+            return results
+
+    raise MatchTimeout(results[0].frame, names, timeout_secs)  # pylint:disable=undefined-loop-variable
+
+
 class MatchTimeout(UITestFailure):
-    """Exception raised by `wait_for_match`.
+    """Exception raised by `wait_for_match` and `wait_for_text`.
 
     :ivar Frame screenshot: The last video frame that `wait_for_match` checked
         before timing out.
 
-    :ivar str expected: Filename of the image that was being searched for.
+    :ivar str expected: Filename of the image (or the text) that was being
+        searched for.
 
     :vartype timeout_secs: int or float
     :ivar timeout_secs: Number of seconds that the image was searched for.
@@ -497,7 +628,8 @@ class MatchTimeout(UITestFailure):
 
 
 @memoize_iterator({"version": "30"})
-def _find_matches(image, template, match_parameters, imglog):
+def _find_matches(image, template, match_parameters, imglog,
+                  early_exit=False):
     """Our image-matching algorithm.
 
     Runs 2 passes: `_find_candidate_matches` to locate potential matches, then
@@ -510,32 +642,97 @@ def _find_matches(image, template, match_parameters, imglog):
     """
 
     if template.shape[2] == 4:
-        # Normalise transparency channel to either 0 or 255
-        mask = template[:, :, 3]
-        mask[mask < 255] = 0
+        template = _template_images.get(
+            template, "normalise_alpha", _normalise_alpha)
 
-    # pylint:disable=undefined-loop-variable
-    for i, first_pass_matched, region, first_pass_certainty in \
-            _find_candidate_matches(image, template, match_parameters, imglog):
-        confirmed = (
+    def confirm(candidate):
+        i, first_pass_matched, region, _ = candidate
+        return (
             first_pass_matched and
             _confirm_match(image, region, template, match_parameters,
                            imwrite=lambda name, img: imglog.imwrite(
-                               "match%d-%s" % (i, name), img)))  # pylint:disable=cell-var-from-loop
+                               "match%d-%s" % (i, name), img)))
+
+    candidates = _find_candidate_matches(
+        image, template, match_parameters, imglog, early_exit)
+
+    # `match` only needs the first candidate, so confirm that one on its own
+    # (`match` doesn't ask this generator for any more). If the caller asks for
+    # more (`match_all`) we extract all the remaining candidates and confirm
+    # them in parallel: `_confirm_match` spends most of its time in OpenCV,
+    # which releases the GIL. The results are yielded in the same order as the
+    # serial algorithm would.
+    first = next(candidates)
+    confirmed = confirm(first)
+    yield (confirmed, list(first[2]), first[1], first[3])
+    if not confirmed:
+        return
+
+    candidates = list(candidates)
+    if imglog.enabled or len(candidates) < 2:
+        # Keep the debug output deterministic.
+        confirmations = (confirm(c) for c in candidates)
+    else:
+        confirmations = _imap_window(_confirm_pool(), confirm, candidates,
+                                     _CONFIRM_THREADS)
 
+    for (_, first_pass_matched, region, first_pass_certainty), confirmed in \
+            zip(candidates, confirmations):
         yield (confirmed, list(region), first_pass_matched,
                first_pass_certainty)
         if not confirmed:
             break
 
 
-def _find_candidate_matches(image, template, match_parameters, imglog):
+_CONFIRM_THREADS = min(multiprocessing.cpu_count(), 8)
+_confirm_pool_instance = None
+_confirm_pool_lock = threading.Lock()
+
+
+def _confirm_pool():
+    """Thread pool used by `_find_matches` to confirm candidate matches."""
+    global _confirm_pool_instance
+    with _confirm_pool_lock:
+        if _confirm_pool_instance is None:
+            from multiprocessing.pool import ThreadPool
+            _confirm_pool_instance = ThreadPool(_CONFIRM_THREADS)
+        return _confirm_pool_instance
+
+
+def _imap_window(pool, func, items, window):
+    """Like ``pool.imap(func, items)``, but only submits ``window`` items to
+    the pool ahead of the caller.
+
+    `_find_matches` stops at the first candidate that isn't confirmed, and
+    callers of `match_all` often stop iterating early, so we don't want to
+    confirm all the candidates up-front like ``imap`` would.
+
+    >>> from multiprocessing.pool import ThreadPool
+    >>> list(_imap_window(ThreadPool(2), lambda x: x * 2, range(5), 2))
+    [0, 2, 4, 6, 8]
+    """
+    items = iter(items)
+    pending = deque(pool.apply_async(func, (x,))
+                    for x in itertools.islice(items, window))
+    while pending:
+        result = pending.popleft().get()
+        for x in itertools.islice(items, 1):
+            pending.append(pool.apply_async(func, (x,)))
+        yield result
+
+
+def _find_candidate_matches(image, template, match_parameters, imglog,
+                            early_exit=False):
     """First pass: Search for `template` in the entire `image`.
 
     This searches the entire image, so speed is more important than accuracy.
     False positives are ok; we apply a second pass later (`_confirm_match`) to
     weed out false positives.
 
+    If `early_exit` is true and `image` is the same size as `template`, we stop
+    comparing them as soon as it's clear that they don't match, so the
+    certainty we report for a non-match is only an upper bound.
+
     http://docs.opencv.org/modules/imgproc/doc/object_detection.html
     http://opencv-code.com/tutorials/fast-template-matching-with-image-pyramid
     """
@@ -565,7 +762,14 @@ def _find_candidate_matches(image, template, match_parameters, imglog):
         # etc.  This is particularly useful for full-image matching.
         ddebug("stbt-match: frame and template sizes match: Using fast-path")
         imglog.set(fast_path=True)
-        s, n = sqdiff(template, image)
+        n = _template_images.get(template, "sqdiff_count", _sqdiff_count)
+        if early_exit:
+            # +1 so that rounding can't turn a match into an early exit.
+            max_total = int(
+                (1 - match_parameters.match_threshold) * n * 255 * 255) + 1
+        else:
+            max_total = None
+        s, _ = sqdiff(template, image, max_total)
         if n == 0:
             certainty = 1
         else:
@@ -575,16 +779,14 @@ def _find_candidate_matches(image, template, match_parameters, imglog):
         yield (0, False, _image_region(image), 0.)
         return
 
-    if template.shape[2] == 4:
-        # OpenCV wants mask to match template's number of channels
-        mask = cv2.cvtColor(template[:, :, 3], cv2.COLOR_GRAY2BGR)
-        template = template[:, :, 0:3]
-    else:
-        mask = None
+    if template.shape[2] == 1 and image.shape[2] == 3:
+        # A greyscale reference image against a colour frame. (The fast-path
+        # above compares them without converting the frame; see `sqdiff`.)
+        image = _frame_grayscale(image)[:, :, numpy.newaxis]
 
-    template_pyramid = _build_pyramid(template, levels, is_template=True)
-    mask_pyramid = _build_pyramid(mask, len(template_pyramid), is_mask=True)
-    image_pyramid = _build_pyramid(image, len(mask_pyramid))
+    template_pyramid, mask_pyramid = _template_images.get(
+        template, "pyramids", _build_template_pyramids, levels)
+    image_pyramid = _build_frame_pyramid(image, len(mask_pyramid), levels)
     roi_mask = None  # Initial region of interest: The whole image.
 
     for level in reversed(range(len(image_pyramid))):
@@ -632,29 +834,96 @@ def _find_candidate_matches(image, template, match_parameters, imglog):
     region = Region(*_upsample(best_match_position, level),
                     width=template.shape[1], height=template.shape[0])
 
-    for i in itertools.count():
-
-        imglog.imwrite("match%d-heatmap" % i, heatmap, scale=heatmap_scale)
-        yield (i, matched, region, certainty)
-        if not matched:
-            return
-        assert level == 0
-
-        # Exclude any positions that would overlap the previous match, then
-        # keep iterating until we don't find any more matches.
-        exclude = region.extend(x=-(region.width - 1), y=-(region.height - 1))
-        cv2.rectangle(
-            heatmap,
-            # -1 because cv2.rectangle considers the bottom-right point to be
-            # *inside* the rectangle.
-            (exclude.x, exclude.y), (exclude.right - 1, exclude.bottom - 1),
-            heatmap_scale,
-            cv2_compat.FILLED)
-
-        matched, best_match_position, certainty = _find_best_match_position(
-            heatmap, heatmap_scale, threshold, level)
-        region = Region(*best_match_position,
+    imglog.imwrite("match0-heatmap", heatmap, scale=heatmap_scale)
+    yield (0, matched, region, certainty)
+    if not matched:
+        return
+    assert level == 0
+
+    # The caller wants more than one match (`match_all`): Find all the other
+    # positions that don't overlap a previous match in a single pass.
+    peaks, (last_position, last_certainty) = _find_peaks(
+        heatmap, heatmap_scale, threshold, template.shape[1::-1],
+        exclude=best_match_position)
+    ddebug("Level 0: Found %d more candidate matches" % len(peaks))
+
+    for i, (position, certainty) in enumerate(peaks, 1):
+        if imglog.enabled:
+            _exclude_from_heatmap(heatmap, heatmap_scale, region)
+            imglog.imwrite("match%d-heatmap" % i, heatmap, scale=heatmap_scale)
+        region = Region(*position,
                         width=template.shape[1], height=template.shape[0])
+        yield (i, True, region, certainty)
+
+    if imglog.enabled:
+        _exclude_from_heatmap(heatmap, heatmap_scale, region)
+        imglog.imwrite("match%d-heatmap" % (len(peaks) + 1), heatmap,
+                       scale=heatmap_scale)
+    yield (len(peaks) + 1, False,
+           Region(*last_position,
+                  width=template.shape[1], height=template.shape[0]),
+           last_certainty)
+
+
+def _find_peaks(heatmap, scale, threshold, template_size, exclude):
+    """Find all the non-overlapping positions in `heatmap` that match, other
+    than the match at position `exclude` (which the caller has already found
+    with `_find_best_match_position`).
+
+    This gives the same results as repeatedly calling
+    `_find_best_match_position` and then excluding the positions that would
+    overlap that match, but it only looks at the whole heatmap once, instead of
+    once per match.
+
+    Returns a list of `(position, certainty)` tuples, in order of decreasing
+    certainty, and the `(position, certainty)` of the best remaining position
+    that didn't match.
+    """
+    width, height = template_size
+    heatmap_width = heatmap.shape[1]
+    certainties = 1 - heatmap.astype(numpy.float64) / scale
+
+    excluded = numpy.zeros(heatmap.shape, dtype=bool)
+    excluded_flat = excluded.reshape(-1)
+
+    def exclude_overlapping(x, y):
+        excluded[max(0, y - height + 1):y + height,
+                 max(0, x - width + 1):x + width] = True
+
+    exclude_overlapping(*exclude)
+
+    candidates = numpy.flatnonzero((certainties >= threshold) & ~excluded)
+    # A stable sort, so that ties are broken in the same order as
+    # `cv2.minMaxLoc`.
+    candidates = candidates[numpy.argsort(-certainties.flat[candidates],
+                                          kind="mergesort")]
+
+    peaks = []
+    for n in candidates.tolist():
+        if excluded_flat[n]:
+            continue
+        y, x = divmod(n, heatmap_width)
+        peaks.append((Position(x, y), float(certainties.flat[n])))
+        exclude_overlapping(x, y)
+
+    # Excluded positions have certainty 0, as if `_exclude_from_heatmap` had
+    # been applied to each of them.
+    certainties[excluded] = 0
+    n = int(numpy.argmax(certainties))
+    y, x = divmod(n, heatmap_width)
+    return peaks, (Position(x, y), float(certainties.flat[n]))
+
+
+def _exclude_from_heatmap(heatmap, scale, region):
+    # Exclude any positions that would overlap the previous match.
+    exclude = region.extend(x=-(region.width - 1), y=-(region.height - 1))
+    cv2.rectangle(
+        heatmap,
+        # -1 because cv2.rectangle considers the bottom-right point to be
+        # *inside* the rectangle.
+        (exclude.x, exclude.y), (exclude.right - 1, exclude.bottom - 1),
+        scale,
+        cv2_compat.FILLED)
 
 
 def _match_template(image, template, mask, method, roi_mask, level, imwrite):  # pylint:disable=redefined-outer-name
@@ -783,6 +1052,78 @@ def _build_pyramid(image, levels, is_template=False, is_mask=False):
     return pyramid
 
 
+# Reference images loaded from disk are cached & read-only (see
+# `_load_image`), so we can cache the images that we derive from them too.
+# These are only cached in memory: Building a template's pyramids is faster
+# than loading them from a file.
+_template_images = _DerivedImages(max_entries=1024,
+                                  max_bytes=128 * 1024 * 1024)
+
+
+def _normalise_alpha(template):
+    """Normalise transparency channel to either 0 or 255."""
+    template = template.copy()
+    mask = template[:, :, 3]
+    mask[mask < 255] = 0
+    return template
+
+
+def _sqdiff_count(template):
+    """The number of values that `sqdiff` compares for `template`."""
+    if template.shape[2] == 4:
+        return numpy.count_nonzero(template[:, :, 3] == 255) * 3
+    else:
+        return template.size
+
+
+def _build_template_pyramids(template, levels):
+    """Returns the pyramids of the template and of its transparency mask (or
+    a list of ``None`` if the template doesn't have transparency).
+    """
+    if template.shape[2] == 4:
+        # OpenCV wants mask to match template's number of channels
+        mask = cv2.cvtColor(template[:, :, 3], cv2.COLOR_GRAY2BGR)
+        template = template[:, :, 0:3]
+    else:
+        mask = None
+
+    template_pyramid = _build_pyramid(template, levels, is_template=True)
+    mask_pyramid = _build_pyramid(mask, len(template_pyramid), is_mask=True)
+    return template_pyramid, mask_pyramid
+
+
+def _build_frame_pyramid(image, levels, max_levels):
+    """Like `_build_pyramid` for the frame (not the template), but shares the
+    pyramid with other callers via `_derived_images`.
+
+    The pyramid for ``levels`` is always a prefix of the pyramid for
+    ``max_levels``, so we build (and cache) the largest pyramid that any
+    template might need.
+    """
+    if not _derived_images.enabled_for(image):
+        return _build_pyramid(image, levels)
+    return _derived_images.get(
+        image, "pyramid", _build_pyramid, max(levels, max_levels))[:levels]
+
+
+def _frame_grayscale(image, region=None):
+    """Returns a grayscale copy of ``region`` of ``image``, or (if ``region``
+    is None) a read-only grayscale conversion of the whole of ``image``.
+
+    We convert (and cache) the whole frame and crop that, rather than caching
+    each region, so that confirming many candidate matches only uses one
+    entry in `_derived_images` instead of evicting the frame's pyramid.
+    """
+    if region is None:
+        return _derived_images.get(
+            image, "gray", cv2.cvtColor, cv2.COLOR_BGR2GRAY)
+    if not _derived_images.enabled_for(image):
+        return cv2.cvtColor(crop(image, region), cv2.COLOR_BGR2GRAY)
+    gray = _derived_images.get(image, "gray", cv2.cvtColor, cv2.COLOR_BGR2GRAY)
+    # Copy because `_confirm_match` modifies the result in-place.
+    return crop(gray, region).copy()
+
+
 def _upsample(position, levels):
     """Convert position coordinates by the given number of pyramid levels.
 
@@ -816,15 +1157,24 @@ def _confirm_match(image, region, template, match_parameters, imwrite):
         mask = None
 
     # Set Region Of Interest to the "best match" location
-    image = image[region.y:region.bottom, region.x:region.right]
-    imwrite("confirm-source_roi", image)
+    roi = image[region.y:region.bottom, region.x:region.right]
+    imwrite("confirm-source_roi", roi)
     if image.shape[2] == 3:
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+        image = _frame_grayscale(image, region)
+        if template.shape[2] == 3:
+            template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+        else:
+            template = template[:, :, 0]
+    else:
+        image = roi
     imwrite("confirm-source_roi_gray", image)
     imwrite("confirm-template_gray", template)
 
     if match_parameters.confirm_method == ConfirmMethod.NORMED_ABSDIFF:
+        # Copy because `image` and `template` may be views onto the frame or
+        # the (shared, read-only) reference image.
+        image = image.copy()
+        template = template.copy()
         cv2.normalize(image, image, 0, 255, cv2.NORM_MINMAX, mask=mask)
         cv2.normalize(template, template, 0, 255, cv2.NORM_MINMAX, mask=mask)
         imwrite("confirm-source_roi_gray_normalized", image)
@@ -11,8 +11,9 @@ from collections import deque
 import cv2
 
 from .config import ConfigurationError, get_config
-from .imgutils import (_frame_repr, _image_region, _ImageFromUser, _load_image,
-                       pixel_bounding_box, crop, limit_time)
+from .imgutils import (_derived_images, _frame_repr, _image_region,
+                       _ImageFromUser, _load_image, pixel_bounding_box, crop,
+                       limit_time)
 from .logging import debug, draw_on, ImageLogger
 from .types import Region, UITestFailure
 
@@ -97,8 +98,8 @@ def detect_motion(timeout_secs=10, noise_threshold=None, mask=None,
 
     region = Region.intersect(_image_region(frame), region)
 
-    previous_frame_gray = cv2.cvtColor(crop(frame, region),
-                                       cv2.COLOR_BGR2GRAY)
+    previous_frame_gray = _derived_images.get(
+        crop(frame, region), "gray", cv2.cvtColor, cv2.COLOR_BGR2GRAY)
     if (mask.image is not None and
             mask.image.shape[:2] != previous_frame_gray.shape[:2]):
         raise ValueError(
@@ -112,7 +113,8 @@ def detect_motion(timeout_secs=10, noise_threshold=None, mask=None,
         imglog.imwrite("source", frame)
         imglog.set(roi=region, noise_threshold=noise_threshold)
 
-        frame_gray = cv2.cvtColor(crop(frame, region), cv2.COLOR_BGR2GRAY)
+        frame_gray = _derived_images.get(
+            crop(frame, region), "gray", cv2.cvtColor, cv2.COLOR_BGR2GRAY)
         imglog.imwrite("gray", frame_gray)
         imglog.imwrite("previous_frame_gray", previous_frame_gray)
 
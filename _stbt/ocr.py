@@ -6,21 +6,33 @@ from __future__ import print_function
 from __future__ import absolute_import
 from builtins import *  # pylint:disable=redefined-builtin,unused-wildcard-import,wildcard-import,wrong-import-order
 
+import atexit
 import errno
 import glob
+import json
+import math
+import multiprocessing
 import os
 import re
+import shutil
 import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from distutils.version import LooseVersion
 from enum import IntEnum
 
 import cv2
 import numpy
 
-from . import imgproc_cache
+from . import cv2_compat, imgproc_cache, libtesseract
 from .config import get_config
-from .imgutils import _frame_repr, _image_region, crop
-from .logging import debug, ImageLogger, warn
+from .imgproc_cache import _cache_hash, _LruCache, _MISSING
+from .imgutils import (_derived_images, _frame_repr, _image_region, crop,
+                       limit_time)
+from .logging import debug, get_debug_level, ImageLogger, warn
+from .match import MatchTimeout
 from .types import Region
 from .utils import named_temporary_directory, to_unicode
 
@@ -272,6 +284,74 @@ def ocr(frame=None, region=Region.ALL,
     return text
 
 
+def ocr_many(frame, regions, mode=OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD,
+             lang=None, tesseract_config=None, tesseract_user_words=None,
+             tesseract_user_patterns=None, upsample=True, text_color=None,
+             text_color_threshold=None, engine=None, char_whitelist=None):
+    """Read the text in several regions of the same video frame.
+
+    This gives the same results as calling `ocr` for each region, but it reads
+    the regions concurrently (using up to 8 CPU cores), so it's faster when
+    there are several regions to read: for example the fields of a
+    `FrameObject` representing a programme guide.
+
+    Each region is still upsampled and thresholded (see ``upsample`` and
+    ``text_color``) separately. Doing this once for the bounding box of all
+    the regions would change the pixels at the edges of each region, because
+    the interpolation would take into account the pixels just outside the
+    region, so the results wouldn't match `ocr`'s (or the results already in
+    the image-processing cache). It's cheap compared to the OCR itself.
+
+    :param frame: The video frame to read from, or None to grab a new frame
+        from the device-under-test.
+    :param regions: The regions of the frame to read.
+    :type regions: list of `Region`
+
+    The other parameters are the same as for `ocr`, and they apply to every
+    region.
+
+    :returns: A list with the text from each region (unicode strings), in the
+        same order as ``regions``.
+
+    | Added in v31.
+    """
+    if frame is None:
+        import stbt
+        frame = stbt.get_frame()
+
+    regions = list(regions)
+
+    def ocr_region(region):
+        return ocr(frame, region, mode, lang, tesseract_config,
+                   tesseract_user_words, tesseract_user_patterns, upsample,
+                   text_color, text_color_threshold, engine, char_whitelist)
+
+    if len(regions) < 2 or get_debug_level() > 1:
+        # Keep the debug output deterministic.
+        return [ocr_region(r) for r in regions]
+    else:
+        return _ocr_pool().map(ocr_region, regions)
+
+
+_ocr_pool_instance = None
+_ocr_pool_lock = threading.Lock()
+
+
+def _ocr_pool():
+    """Thread pool used by `ocr_many`.
+
+    Tesseract runs in a separate process, or in libtesseract with the GIL
+    released, so OCR of several regions can run in parallel.
+    """
+    global _ocr_pool_instance
+    with _ocr_pool_lock:
+        if _ocr_pool_instance is None:
+            from multiprocessing.pool import ThreadPool
+            _ocr_pool_instance = ThreadPool(
+                min(multiprocessing.cpu_count(), 8))
+        return _ocr_pool_instance
+
+
 def match_text(text, frame=None, region=Region.ALL,
                mode=OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD, lang=None,
                tesseract_config=None, case_sensitive=False, upsample=True,
@@ -312,11 +392,113 @@ def match_text(text, frame=None, region=Region.ALL,
     | Added in v30: The ``engine`` parameter and support for Tesseract v4.
     | Added in v31: The ``char_whitelist`` parameter.
     """
-    import lxml.etree
     if frame is None:
         import stbt
         frame = stbt.get_frame()
 
+    if get_config("ocr", "find_text_regions", type_=bool):
+        find_text_regions = _find_text_regions
+    else:
+        find_text_regions = None
+
+    return _match_text(text, frame, region, mode, lang, tesseract_config,
+                       case_sensitive, upsample, text_color,
+                       text_color_threshold, engine, char_whitelist,
+                       find_text_regions)
+
+
+def wait_for_text(text, timeout_secs=10, consecutive_matches=1,
+                  region=Region.ALL,
+                  mode=OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD, lang=None,
+                  tesseract_config=None, case_sensitive=False, upsample=True,
+                  text_color=None, text_color_threshold=None, engine=None,
+                  char_whitelist=None, frames=None):
+    """Search for the specified text in the device-under-test's video stream.
+
+    :param unicode text: The text to search for. See `match_text`.
+
+    :type timeout_secs: int or float or None
+    :param timeout_secs:
+        A timeout in seconds. This function will raise `MatchTimeout` if the
+        text isn't found within this time.
+
+    :param int consecutive_matches:
+        Forces this function to wait for several consecutive frames with the
+        text found at the same position. See `wait_for_match`.
+
+    :param region: See `ocr`.
+    :param mode: See `ocr`.
+    :param lang: See `ocr`.
+    :param tesseract_config: See `ocr`.
+    :param case_sensitive: See `match_text`.
+    :param upsample: See `ocr`.
+    :param text_color: See `ocr`.
+    :param text_color_threshold: See `ocr`.
+    :param engine: See `ocr`.
+    :param char_whitelist: See `ocr`.
+
+    :type frames: Iterator[stbt.Frame]
+    :param frames: An iterable of video-frames to analyse. Defaults to
+        ``stbt.frames()``.
+
+    :returns: `TextMatchResult` when the text is found.
+    :raises: `MatchTimeout` if the text isn't found after ``timeout_secs``
+        seconds.
+
+    This is faster than calling `match_text` in a loop: It looks for the text
+    where it found it in the previous frame first, and (if
+    ``find_text_regions`` is enabled in the ``[ocr]`` section of
+    :ref:`.stbt.conf`) it doesn't look for the lines of text again if the
+    region hasn't changed since the previous frame.
+
+    Added in v31.
+    """
+    if frames is None:
+        import stbt
+        frames = stbt.frames(timeout_secs=timeout_secs)
+    else:
+        frames = limit_time(frames, timeout_secs)
+
+    if get_config("ocr", "find_text_regions", type_=bool):
+        find_text_regions = _TextRegionsOfLastFrame()
+    else:
+        find_text_regions = None
+
+    match_count = 0
+    last_region = None
+    debug("Searching for text %r" % (text,))
+    res = None
+    for frame in frames:
+        res = _match_text(text, frame, region, mode, lang, tesseract_config,
+                          case_sensitive, upsample, text_color,
+                          text_color_threshold, engine, char_whitelist,
+                          find_text_regions, res)
+        if res.match and (match_count == 0 or res.region == last_region):
+            match_count += 1
+        else:
+            match_count = 0
+        last_region = res.region
+        if match_count == consecutive_matches:
+            debug("Found text %r" % (text,))
+            return res
+
+    raise MatchTimeout(res.frame, text, timeout_secs)  # pylint:disable=undefined-loop-variable
+
+
+def _match_text(text, frame, region, mode, lang, tesseract_config,
+                case_sensitive, upsample, text_color, text_color_threshold,
+                engine, char_whitelist, find_text_regions, last_result=None):
+    """Implementation of `match_text`.
+
+    :param find_text_regions: None to run OCR on the whole region, or a
+        function like `_find_text_regions` to run OCR on each line of text
+        separately, stopping as soon as we find `text`.
+    :param last_result: The result for the previous frame, from
+        `wait_for_text`. If it was a match we run OCR where we found it first
+        (on that line of text, if ``find_text_regions`` is given).
+    """
+    import lxml.etree
+
     _config = dict(tesseract_config or {})
     _config['tessedit_create_hocr'] = 1
 
@@ -324,14 +506,30 @@ def match_text(text, frame=None, region=Region.ALL,
 
     imglog = ImageLogger("match_text")
 
-    xml, region = _tesseract(frame, region, mode, lang, _config,
-                             None, text.split(), upsample, text_color,
-                             text_color_threshold, engine, char_whitelist,
-                             imglog)
-    if xml == '':
-        hocr = None
-        result = TextMatchResult(rts, False, None, frame, text)
+    if find_text_regions is not None:
+        regions = find_text_regions(frame, region)
+        if last_result is not None and last_result.match:
+            regions = sorted(regions, key=lambda r: not r.contains(
+                last_result.region))
+        imglog.set(text_regions=regions)
     else:
+        regions = [region]
+        if last_result is not None and last_result.match:
+            # Tesseract needs a margin around the text:
+            near = Region.intersect(region, last_result.region.extend(
+                x=-10, y=-10, right=10, bottom=10))
+            if near is not None:
+                regions.insert(0, near)
+
+    result = TextMatchResult(rts, False, None, frame, text)
+    hocr = None
+    for region in regions:
+        xml, region = _tesseract(frame, region, mode, lang, _config,
+                                 None, text.split(), upsample, text_color,
+                                 text_color_threshold, engine, char_whitelist,
+                                 imglog)
+        if xml == '':
+            continue
         hocr = lxml.etree.fromstring(xml.encode('utf-8'))
         p = _hocr_find_phrase(hocr, to_unicode(text).split(), case_sensitive)
         if p:
@@ -346,8 +544,7 @@ def match_text(text, frame=None, region=Region.ALL,
                 region.x + box.x // n, region.y + box.y // n,
                 region.x + box.right // n, region.y + box.bottom // n)
             result = TextMatchResult(rts, True, box, frame, text)
-        else:
-            result = TextMatchResult(rts, False, None, frame, text)
+            break
 
     if result.match:
         debug("match_text: Match found: %s" % str(result))
@@ -452,11 +649,40 @@ def _tesseract(frame, region, mode, lang, _config, user_patterns, user_words,
         region = intersection
         imglog.set(region=region)
 
-    return (_tesseract_subprocess(crop(frame, region), mode, lang, _config,
-                                  user_patterns, user_words, upsample,
-                                  text_color, text_color_threshold, engine,
-                                  char_whitelist, imglog, tesseract_version),
-            region)
+    cropped = crop(frame, region)
+    key = None
+    if not imglog.enabled:
+        # When polling (e.g. with `wait_until`) the region is usually the same
+        # as last time, so remember the last result for each region &
+        # parameters and skip OCR if the pixels haven't changed. (If imglog is
+        # enabled we always run tesseract so that we can log its intermediate
+        # images.)
+        try:
+            key = _cache_hash([region, mode, lang, _config, user_patterns,
+                               user_words, upsample, text_color,
+                               text_color_threshold, engine, char_whitelist,
+                               tesseract_version])
+        except TypeError:
+            # e.g. a value in `tesseract_config` that we don't know how to
+            # hash. We'll run tesseract every time.
+            pass
+    if key is not None:
+        digest = _cache_hash(cropped)
+        last = _last_results.get(key)
+        if last is not _MISSING and last[0] == digest:
+            return (last[1], region)
+
+    result = _tesseract_subprocess(cropped, mode, lang, _config,
+                                   user_patterns, user_words, upsample,
+                                   text_color, text_color_threshold, engine,
+                                   char_whitelist, imglog, tesseract_version)
+    if key is not None:
+        _last_results.put(key, (digest, result), len(result or ""))
+    return (result, region)
+
+
+# The result of the last OCR of each region, see `_tesseract`:
+_last_results = _LruCache(max_entries=64, max_bytes=1024 * 1024)
 
 
 @imgproc_cache.memoize({"version": "30"})
@@ -477,111 +703,561 @@ def _tesseract_subprocess(
         # significantly reduces the error rate by more than 6x in tests.  This
         # uses bilinear interpolation which produces the best results.  See
         # http://stb-tester.com/blog/2014/04/14/improving-ocr-accuracy.html
-        outsize = (frame.shape[1] * 3, frame.shape[0] * 3)
-        frame = cv2.resize(frame, outsize, interpolation=cv2.INTER_LINEAR)
+        frame = _derived_images.get(frame, "upsample", _upsample)
         imglog.imwrite("upsampled", frame)
 
     if text_color is not None:
-        # Calculate distance of each pixel from `text_color`, then discard
-        # everything further than `text_color_threshold` distance away.
-        diff = numpy.subtract(frame, text_color, dtype=numpy.int32)
-        frame = numpy.sqrt((diff[:, :, 0] ** 2 +
-                            diff[:, :, 1] ** 2 +
-                            diff[:, :, 2] ** 2) // 3) \
-                     .astype(numpy.uint8)
-        imglog.imwrite("text_color_difference", frame)
-        _, frame = cv2.threshold(frame, text_color_threshold, 255,
-                                 cv2.THRESH_BINARY)
-        imglog.imwrite("text_color_threshold", frame)
-
-    # $XDG_RUNTIME_DIR is likely to be on tmpfs:
+        # NB we do this after upsampling, not before: Thresholding the
+        # interpolated colours gives smoother edges, and it's what the OCR
+        # results in the cache were calculated with.
+        frame = _text_color_threshold(frame, text_color, text_color_threshold,
+                                      imglog)
+
+    # NB the choice of engine doesn't depend on `imglog.enabled`, so that
+    # debugging doesn't change the results. We only get tesseract's
+    # intermediate images ("tessinput") from the executable.
+    use_library = _use_libtesseract(tesseract_version)
+    _config = _tesseract_config(_config, user_words, user_patterns,
+                                char_whitelist,
+                                imglog.enabled and not use_library,
+                                tesseract_version)
+
+    if use_library:
+        if tesseract_version >= LooseVersion("4.0"):
+            oem = int(engine)
+        else:
+            oem = libtesseract.OEM_DEFAULT
+        return _tesseract_library(
+            frame, mode, lang, oem, _config, user_words, user_patterns,
+            tessdata_suffix, tesseract_version)
+
+    # Pass the image to tesseract on stdin and read its output from stdout,
+    # rather than encoding a (3x upsampled, so very large) PNG file for
+    # tesseract to decode again:
+    pnm = None
+    if tesseract_version >= LooseVersion("3.04"):
+        pnm = _encode_pnm(frame)
+
+    if pnm is not None and not imglog.enabled:
+        return _tesseract_executable(
+            frame, pnm, mode, lang, engine_flags, _config, user_words,
+            user_patterns, tessdata_suffix, tesseract_version, imglog, None)
+
+    # We need a directory for the PNG file, or for tesseract to write its
+    # intermediate images to. $XDG_RUNTIME_DIR is likely to be on tmpfs:
     tmpdir = os.environ.get("XDG_RUNTIME_DIR", None)
-
     with named_temporary_directory(prefix='stbt-ocr-', dir=tmpdir) as tmp:
+        return _tesseract_executable(
+            frame, pnm, mode, lang, engine_flags, _config, user_words,
+            user_patterns, tessdata_suffix, tesseract_version, imglog, tmp)
 
-        if tesseract_version >= LooseVersion("3.05"):
-            psm_flag = "--psm"
-        else:
-            psm_flag = "-psm"
 
+def _tesseract_executable(frame, pnm, mode, lang, engine_flags, _config,
+                          user_words, user_patterns, tessdata_suffix,
+                          tesseract_version, imglog, tmp):
+    """Runs the tesseract executable. It reads `pnm` from stdin, or `frame`
+    from a PNG file in `tmp` if `pnm` is None."""
+
+    if tesseract_version >= LooseVersion("3.05"):
+        psm_flag = "--psm"
+    else:
+        psm_flag = "-psm"
+
+    if pnm is not None:
+        cmd = ["tesseract", '-l', lang, 'stdin', 'stdout']
+    else:
         cmd = ["tesseract", '-l', lang,
                tmp + '/input.png',
-               tmp + '/output',
-               psm_flag, str(int(mode))] + engine_flags
-
-        tessenv = os.environ.copy()
-
-        if (_config or user_words or user_patterns or char_whitelist or
-                imglog.enabled):
-            tessdata_dir = tmp + '/tessdata'
-            os.mkdir(tessdata_dir)
-            _symlink_copy_dir(_find_tessdata_dir(tessdata_suffix), tmp)
-            tessenv['TESSDATA_PREFIX'] = tmp + '/'
-            if tesseract_version >= LooseVersion("4.0.0"):
-                tessenv['TESSDATA_PREFIX'] += "tessdata"
-
-        if ('tessedit_create_hocr' in _config and
-                tesseract_version >= LooseVersion('3.04')):
-            _config['tessedit_create_txt'] = 0
-
-        if user_words:
-            if 'user_words_suffix' in _config:
-                raise ValueError(
-                    "You cannot specify 'user_words' and " +
-                    "'tesseract_config[\"user_words_suffix\"]' " +
-                    "at the same time")
-            with open('%s/%s.user-words' % (tessdata_dir, lang), 'w') as f:
-                f.write('\n'.join(to_unicode(x) for x in user_words))
-            _config['user_words_suffix'] = 'user-words'
-
-        if user_patterns:
-            if 'user_patterns_suffix' in _config:
-                raise ValueError(
-                    "You cannot specify 'user_patterns' and " +
-                    "'tesseract_config[\"user_patterns_suffix\"]' " +
-                    "at the same time")
-            with open('%s/%s.user-patterns' % (tessdata_dir, lang), 'w') as f:
-                f.write('\n'.join(to_unicode(x) for x in user_patterns))
-            _config['user_patterns_suffix'] = 'user-patterns'
-
-        if char_whitelist:
-            if 'tessedit_char_whitelist' in _config:
-                raise ValueError(
-                    "You cannot specify 'char_whitelist' and " +
-                    "'tesseract_config[\"tessedit_char_whitelist\"]' " +
-                    "at the same time")
-            _config["tessedit_char_whitelist"] = char_whitelist
-
-        if imglog.enabled:
-            _config['tessedit_write_images'] = True
-
-        if _config:
-            with open(tessdata_dir + '/configs/stbtester', 'w') as cfg:
-                for k, v in _config.items():
-                    if isinstance(v, bool):
-                        cfg.write(('%s %s\n' % (k, 'T' if v else 'F')))
-                    else:
-                        cfg.write("%s %s\n" % (k, to_unicode(v)))
-            cmd += ['stbtester']
-
-        cv2.imwrite(tmp + '/input.png', frame)
-        try:
+               tmp + '/output']
+    cmd += [psm_flag, str(int(mode))] + engine_flags
+
+    tessenv = os.environ.copy()
+
+    staged = None
+    if _config:
+        staged = _tessdata_cache.acquire(
+            tessdata_suffix, lang, _config, user_words, user_patterns,
+            tesseract_version)
+        tessenv['TESSDATA_PREFIX'] = staged.prefix
+        cmd += ['stbtester']
+
+    try:
+        if pnm is not None:
+            p = subprocess.Popen(
+                cmd, cwd=tmp, env=tessenv, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, stderr = p.communicate(pnm)
+            if p.returncode != 0:
+                raise subprocess.CalledProcessError(
+                    p.returncode, cmd, output=stderr)
+        else:
+            output = None
+            cv2.imwrite(tmp + '/input.png', frame)
             subprocess.check_output(cmd, cwd=tmp, env=tessenv,
                                     stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            warn("Tesseract failed: %s" % e.output.decode("utf-8", "replace"))
+    except subprocess.CalledProcessError as e:
+        warn("Tesseract failed: %s" % e.output.decode("utf-8", "replace"))
+        raise
+    finally:
+        if staged is not None:
+            _tessdata_cache.release(staged)
+
+    if imglog.enabled:
+        tessinput = os.path.join(tmp, "tessinput.tif")
+        if os.path.exists(tessinput):
+            imglog.imwrite("tessinput", cv2.imread(tessinput))
+
+    if output is not None:
+        return output.decode("utf-8")
+
+    for filename in glob.glob(tmp + "/output.*"):
+        _, ext = os.path.splitext(filename)
+        if ext == ".txt" or ext == ".hocr":
+            with open(filename) as f:
+                return f.read()
+
+
+def _encode_pnm(frame):
+    """Encodes `frame` as a binary PGM (greyscale) or PPM (RGB) image: a short
+    header followed by the raw pixels. Returns None if `frame` isn't 8-bit
+    greyscale or BGR."""
+    if frame.dtype != numpy.uint8:
+        return None
+    if frame.ndim == 2 or (frame.ndim == 3 and frame.shape[2] == 1):
+        magic = b"P5"
+        pixels = frame
+    elif frame.ndim == 3 and frame.shape[2] == 3:
+        magic = b"P6"
+        pixels = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    else:
+        return None
+    header = b"%s\n%d %d\n255\n" % (magic, frame.shape[1], frame.shape[0])
+    return header + numpy.ascontiguousarray(pixels).tobytes()
+
+
+def _tesseract_config(_config, user_words, user_patterns, char_whitelist,
+                      write_images, tesseract_version):
+    """The contents of the tesseract config file that we need to write for
+    these parameters (empty if we don't need one).
+
+    :param bool write_images: Ask tesseract to write its intermediate images
+        to its working directory, for the debug image log.
+    """
+    _config = dict(_config)
+
+    if ('tessedit_create_hocr' in _config and
+            tesseract_version >= LooseVersion('3.04')):
+        _config['tessedit_create_txt'] = 0
+
+    if user_words:
+        if 'user_words_suffix' in _config:
+            raise ValueError(
+                "You cannot specify 'user_words' and " +
+                "'tesseract_config[\"user_words_suffix\"]' " +
+                "at the same time")
+        _config['user_words_suffix'] = 'user-words'
+
+    if user_patterns:
+        if 'user_patterns_suffix' in _config:
+            raise ValueError(
+                "You cannot specify 'user_patterns' and " +
+                "'tesseract_config[\"user_patterns_suffix\"]' " +
+                "at the same time")
+        _config['user_patterns_suffix'] = 'user-patterns'
+
+    if char_whitelist:
+        if 'tessedit_char_whitelist' in _config:
+            raise ValueError(
+                "You cannot specify 'char_whitelist' and " +
+                "'tesseract_config[\"tessedit_char_whitelist\"]' " +
+                "at the same time")
+        _config["tessedit_char_whitelist"] = char_whitelist
+
+    if write_images:
+        _config['tessedit_write_images'] = True
+
+    return _config
+
+
+def _stage_tessdata(dest, tessdata_suffix, lang, _config, user_words,
+                    user_patterns, tesseract_version):
+    """Creates a tessdata directory in `dest` with our config file and
+    user-words/user-patterns files.
+
+    Returns the value to use for TESSDATA_PREFIX.
+    """
+    tessdata_dir = dest + '/tessdata'
+    os.mkdir(tessdata_dir)
+    _symlink_copy_dir(_find_tessdata_dir(tessdata_suffix), dest)
+
+    if user_words:
+        with open('%s/%s.user-words' % (tessdata_dir, lang), 'w') as f:
+            f.write('\n'.join(to_unicode(x) for x in user_words))
+
+    if user_patterns:
+        with open('%s/%s.user-patterns' % (tessdata_dir, lang), 'w') as f:
+            f.write('\n'.join(to_unicode(x) for x in user_patterns))
+
+    with open(tessdata_dir + '/configs/stbtester', 'w') as cfg:
+        for k, v in _config.items():
+            if isinstance(v, bool):
+                cfg.write(('%s %s\n' % (k, 'T' if v else 'F')))
+            else:
+                cfg.write("%s %s\n" % (k, to_unicode(v)))
+
+    if tesseract_version >= LooseVersion("4.0.0"):
+        return dest + '/tessdata'
+    else:
+        return dest + '/'
+
+
+class _TessdataCache(object):
+    """Directories created by `_stage_tessdata`, for reuse by later OCR calls
+    with the same parameters.
+
+    Staging a tessdata directory means creating hundreds of symlinks, and
+    `match_text` always needs one (for its user-words), so we keep the
+    `max_entries` most recently used directories. Directories that are in use
+    (between `acquire` and `release`) aren't deleted until they are released.
+    Everything is deleted when the process exits.
+    """
+    class Entry(object):
+        def __init__(self, key, path, prefix):
+            self.key = key
+            self.path = path
+            self.prefix = prefix  # The value to use for TESSDATA_PREFIX
+            self.refs = 1
+            self.evicted = False
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> Entry
+        self._lock = threading.Lock()
+        self._root = None
+
+    def acquire(self, tessdata_suffix, lang, _config, user_words,
+                user_patterns, tesseract_version):
+        source = _find_tessdata_dir(tessdata_suffix)
+        key = json.dumps([source, lang, sorted(_config.items()), user_words,
+                          user_patterns, str(tesseract_version)], default=str)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                entry.refs += 1
+                self._entries[key] = entry  # Most recently used
+                return entry
+            if self._root is None:
+                # $XDG_RUNTIME_DIR is likely to be on tmpfs:
+                self._root = tempfile.mkdtemp(
+                    prefix='stbt-tessdata-',
+                    dir=os.environ.get("XDG_RUNTIME_DIR"))
+            root = self._root
+
+        path = tempfile.mkdtemp(dir=root)
+        try:
+            prefix = _stage_tessdata(
+                path, tessdata_suffix, lang, _config, user_words,
+                user_patterns, tesseract_version)
+        except:
+            shutil.rmtree(path, ignore_errors=True)
             raise
+        entry = _TessdataCache.Entry(key, path, prefix)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                # Another thread staged the same directory at the same time
+                old.evicted = True
+                if old.refs == 0:
+                    shutil.rmtree(old.path, ignore_errors=True)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                _, victim = self._entries.popitem(last=False)
+                victim.evicted = True
+                if victim.refs == 0:
+                    shutil.rmtree(victim.path, ignore_errors=True)
+        return entry
+
+    def release(self, entry):
+        with self._lock:
+            entry.refs -= 1
+            if entry.refs == 0 and entry.evicted:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def clear(self):
+        with self._lock:
+            root = self._root
+            self._entries.clear()
+            self._root = None
+        if root is not None:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+_tessdata_cache = _TessdataCache(max_entries=64)
+atexit.register(_tessdata_cache.clear)
+
+
+def _use_libtesseract(tesseract_version):
+    """Use libtesseract (instead of running the tesseract executable) if it's
+    installed and it's the same version as the executable."""
+    if not get_config("ocr", "use_libtesseract", True, type_=bool):
+        return False
+    v = libtesseract.version()
+    return v is not None and LooseVersion(v) == tesseract_version
+
+
+def _tesseract_library(frame, mode, lang, oem, _config, user_words,
+                       user_patterns, tessdata_suffix, tesseract_version):
+    key = (lang, oem, tessdata_suffix, sorted(_config.items()),
+           user_words, user_patterns)
+    key = json.dumps(key, default=str)
+
+    def new_worker():
+        return _TesseractWorker(lang, oem, _config, user_words, user_patterns,
+                                tessdata_suffix, tesseract_version)
+
+    if frame.ndim == 3:
+        # libtesseract expects RGB
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    hocr = bool(_config.get('tessedit_create_hocr'))
+    with _tesseract_pool.worker(key, new_worker) as worker:
+        text = worker.api.recognize(frame, mode, hocr=hocr)
+    if hocr:
+        # Like the output of the tesseract executable:
+        text = _HOCR_TEMPLATE % text
+    return text
 
-        if imglog.enabled:
-            tessinput = os.path.join(tmp, "tessinput.tif")
-            if os.path.exists(tessinput):
-                imglog.imwrite("tessinput", cv2.imread(tessinput))
 
-        for filename in glob.glob(tmp + "/output.*"):
-            _, ext = os.path.splitext(filename)
-            if ext == ".txt" or ext == ".hocr":
-                with open(filename) as f:
-                    return f.read()
+_HOCR_TEMPLATE = u"""\
+<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+ <head>
+  <title></title>
+  <meta http-equiv="Content-Type" content="text/html;charset=utf-8" />
+  <meta name='ocr-system' content='tesseract' />
+ </head>
+ <body>
+%s
+ </body>
+</html>
+"""
+
+
+class _TesseractWorker(object):
+    """An initialised instance of libtesseract, holding on to its staged
+    tessdata directory (see `_TessdataCache`) if it needs a config file."""
+    def __init__(self, lang, oem, _config, user_words, user_patterns,
+                 tessdata_suffix, tesseract_version):
+        self.api = None
+        self.staged = None
+        try:
+            datapath = None
+            configs = []
+            if _config:
+                self.staged = _tessdata_cache.acquire(
+                    tessdata_suffix, lang, _config, user_words, user_patterns,
+                    tesseract_version)
+                datapath = self.staged.prefix
+                configs = ['stbtester']
+            self.api = libtesseract.TessBaseAPI(datapath, lang, oem, configs)
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self.api is not None:
+            self.api.close()
+            self.api = None
+        if self.staged is not None:
+            _tessdata_cache.release(self.staged)
+            self.staged = None
+
+
+class _TesseractPool(object):
+    """Idle `_TesseractWorker`s, ready for reuse.
+
+    There is one list of workers for each distinct set of tesseract
+    parameters, so each thread running OCR at the same time gets its own
+    worker. We keep the workers for the `max_configs` most recently used sets
+    of parameters.
+    """
+    def __init__(self, max_configs):
+        self.max_configs = max_configs
+        self._idle = OrderedDict()  # key -> [_TesseractWorker]
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def worker(self, key, factory):
+        w = None
+        with self._lock:
+            workers = self._idle.get(key)
+            if workers:
+                w = workers.pop()
+        if w is None:
+            w = factory()
+        try:
+            yield w
+        except:
+            w.close()
+            raise
+
+        evicted = []
+        with self._lock:
+            workers = self._idle.pop(key, [])
+            workers.append(w)
+            self._idle[key] = workers  # Most recently used
+            while len(self._idle) > self.max_configs:
+                _, old = self._idle.popitem(last=False)
+                evicted.extend(old)
+        for x in evicted:
+            x.close()
+
+    def close(self):
+        with self._lock:
+            workers = [w for ws in self._idle.values() for w in ws]
+            self._idle.clear()
+        for w in workers:
+            w.close()
+
+
+_tesseract_pool = _TesseractPool(max_configs=16)
+atexit.register(_tesseract_pool.close)
+
+
+def _upsample(frame):
+    outsize = (frame.shape[1] * 3, frame.shape[0] * 3)
+    return cv2.resize(frame, outsize, interpolation=cv2.INTER_LINEAR)
+
+
+def _text_color_threshold(frame, text_color, text_color_threshold, imglog):
+    """Discard everything further than `text_color_threshold` from
+    `text_color`.
+
+    The distance of each pixel from `text_color` is
+    ``floor(sqrt(floor((db**2 + dg**2 + dr**2) / 3)))``, and pixels with a
+    distance greater than `text_color_threshold` become white (255); the rest
+    become black (0).  Instead of calculating the square root for every pixel
+    we compare the sum of squares against the equivalent threshold, and we
+    look up the squares in a table instead of calculating them:
+
+    >>> frame = numpy.array([[[0, 0, 0], [10, 10, 10], [11, 11, 11]]],
+    ...                     dtype=numpy.uint8)
+    >>> imglog = ImageLogger("test")
+    >>> _text_color_threshold(frame, (0, 0, 0), 10, imglog)
+    array([[  0,   0, 255]], dtype=uint8)
+    >>> _text_color_threshold(frame, (10, 10, 10), 0, imglog)
+    array([[255,   0, 255]], dtype=uint8)
+    """
+    squares = ((numpy.arange(256, dtype=numpy.float32)[:, None] -
+                numpy.array(text_color, dtype=numpy.float32)[None, :]) ** 2)
+    # Sums of squares are integers < 2**24 so float32 represents them exactly:
+    sum_of_squares = cv2.transform(
+        cv2.LUT(frame, squares.reshape((256, 1, 3))),
+        numpy.ones((1, 3), dtype=numpy.float32))
+    if imglog.enabled:
+        imglog.imwrite(
+            "text_color_difference",
+            numpy.sqrt(sum_of_squares.astype(numpy.int32) // 3)
+                 .astype(numpy.uint8))
+
+    # distance > threshold  <=>  sum_of_squares >= 3 * (threshold + 1) ** 2
+    n = max(int(math.floor(text_color_threshold)) + 1, 0)
+    frame = cv2.compare(sum_of_squares, 3 * n * n - 1, cv2.CMP_GT)
+    imglog.imwrite("text_color_threshold", frame)
+    return frame
+
+
+def _find_text_regions(frame, region=Region.ALL):
+    """Find the lines of text within `region` of `frame`, so that `match_text`
+    only needs to upsample and OCR those instead of the whole region.
+
+    This is a quick heuristic, not OCR: Text has many strong edges close
+    together, so we look for areas with a high morphological gradient and join
+    them up horizontally into lines. It will find some things that aren't text
+    (such as icons) but those just cost a little more OCR.
+
+    :returns: A list of `Region`s, in frame coordinates, sorted top to bottom
+        then left to right.
+    """
+    region = Region.intersect(_image_region(frame), region)
+    if region is None:
+        return []
+    image = crop(frame, region)
+    if len(image.shape) == 3 and image.shape[2] == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    gradient = cv2.morphologyEx(
+        image, cv2.MORPH_GRADIENT,
+        cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+    # Otsu picks a threshold even if the region is flat, so don't let it go
+    # below a minimum edge strength:
+    otsu, _ = cv2.threshold(gradient, 0, 255,
+                            cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    _, mask = cv2.threshold(gradient, max(otsu, 32), 255, cv2.THRESH_BINARY)
+    # Remove long horizontal & vertical lines (such as the edges of buttons)
+    # so that they don't get joined up with the text next to them:
+    lines = cv2.bitwise_or(
+        cv2.morphologyEx(mask, cv2.MORPH_OPEN, cv2.getStructuringElement(
+            cv2.MORPH_RECT, (41, 1))),
+        cv2.morphologyEx(mask, cv2.MORPH_OPEN, cv2.getStructuringElement(
+            cv2.MORPH_RECT, (1, 41))))
+    mask = cv2.subtract(mask, lines)
+    # Join the letters & words of each line together:
+    mask = cv2.morphologyEx(
+        mask, cv2.MORPH_CLOSE,
+        cv2.getStructuringElement(cv2.MORPH_RECT, (15, 3)))
+
+    boxes = []
+    for x, y, w, h in cv2_compat.find_contour_boxes(
+            mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE):
+        if w < 6 or h < 6:
+            continue  # Noise, or too small for tesseract to read anyway
+        # Tesseract needs a margin around the text:
+        box = Region.intersect(
+            region,
+            Region(region.x + x - 5, region.y + y - 5, w + 10, h + 10))
+        if box is not None:
+            boxes.append(box)
+
+    # Merge overlapping boxes so that we don't OCR the same text twice:
+    merged = True
+    while merged:
+        merged = False
+        out = []
+        for box in boxes:
+            for i, other in enumerate(out):
+                if Region.intersect(box, other) is not None:
+                    out[i] = Region.bounding_box(box, other)
+                    merged = True
+                    break
+            else:
+                out.append(box)
+        boxes = out
+
+    return sorted(boxes, key=lambda r: (r.y, r.x))
+
+
+class _TextRegionsOfLastFrame(object):
+    """Like `_find_text_regions`, but if the frame is the same as the last
+    frame we were called with (within `region`) we return the same text
+    regions instead of looking for them again. Used by `wait_for_text`.
+    """
+    def __init__(self):
+        self.region = None
+        self.image = None
+        self.text_regions = None
+
+    def __call__(self, frame, region):
+        region = Region.intersect(_image_region(frame), region)
+        if region is None:
+            return []
+        image = crop(frame, region)
+        if (region != self.region or self.image is None or
+                not numpy.array_equal(image, self.image)):
+            self.region = region
+            self.image = image.copy()  # In case the caller modifies `frame`
+            self.text_regions = _find_text_regions(frame, region)
+        return self.text_regions
 
 
 def _hocr_iterate(hocr):
@@ -1,29 +1,79 @@
 #include <stdint.h>
 #include <assert.h>
+#include <pthread.h>
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#define HAVE_X86_SIMD 1
+#include <immintrin.h>
+#endif
 
 enum PixelDepth {
     PIXEL_DEPTH_U8 = 0,
     PIXEL_DEPTH_BGR = 1,
     PIXEL_DEPTH_BGRx = 2,
     PIXEL_DEPTH_BGRA = 3,
+    PIXEL_DEPTH_GRAY_BGR = 4,
 };
 
-static uint32_t sqdiff_U8(
-    const unsigned char* a, const unsigned char* b,
-    uint16_t len_px);
-static uint32_t sqdiff_BGRx(
+static uint64_t sqdiff_BGRx(
     const unsigned char* t, const unsigned char* f,
-    uint16_t len_px);
-static uint32_t sqdiff_BGRA(
+    uint32_t len_px);
+static uint64_t sqdiff_BGRA(
     uint32_t *count,
     const unsigned char* t, const unsigned char* f,
-    uint16_t len_px);
+    uint32_t len_px);
+static uint64_t sqdiff_gray_BGR(
+    const unsigned char* t, const unsigned char* f,
+    uint32_t len_px);
+
+enum SimdLevel {
+    SIMD_NONE = 0,
+    SIMD_SSE2 = 1,
+    SIMD_AVX2 = 2,
+};
+
+typedef uint32_t (*SqdiffU8Func)(
+    const unsigned char* a, const unsigned char* b, uint32_t len);
+
+static uint64_t sqdiff_U8(
+    const unsigned char* a, const unsigned char* b, uint32_t len);
+static uint32_t sqdiff_U8_scalar(
+    const unsigned char* a, const unsigned char* b, uint32_t len);
+#ifdef HAVE_X86_SIMD
+static uint32_t sqdiff_U8_sse2(
+    const unsigned char* a, const unsigned char* b, uint32_t len);
+static uint32_t sqdiff_U8_avx2(
+    const unsigned char* a, const unsigned char* b, uint32_t len);
+#endif
+
+int sqdiff_set_simd_level(int max_level);
+
+/* Selected at runtime by sqdiff_set_simd_level, based on what the CPU
+ * supports. */
+static SqdiffU8Func sqdiff_U8_impl = NULL;
+
+/* The most threads that sqdiff_bounded will use. */
+#define MAX_THREADS 16
+
+/* Don't bother starting a thread for less than this many bytes of the frame:
+ * it wouldn't save more time than it takes to start the thread. Starting and
+ * joining a thread takes ~15-20us, and a thread compares ~10 bytes per ns
+ * (AVX2), so this is ~50us of work per thread: frames smaller than 1MB (such
+ * as a 640x360 BGR region) are processed in the calling thread without
+ * starting any threads. */
+#define MIN_BYTES_PER_THREAD (512 * 1024)
 
 typedef struct _SqdiffResult {
     uint64_t total;
     uint32_t count;
 } SqdiffResult;
 
+SqdiffResult sqdiff_bounded(const uint8_t *t, uint32_t t_stride,
+                            const uint8_t *f, uint32_t f_stride,
+                            uint32_t width_px, uint32_t height_px,
+                            int color_depth, uint64_t max_total,
+                            int n_threads);
+
 /* Computes the square difference between template t and frame f and counts
  * the number of pixels not masked.
  *
@@ -34,6 +84,11 @@ typedef struct _SqdiffResult {
  * PIXEL_DEPTH_BGR        BGR                   BGR
  * PIXEL_DEPTH_BGRx       BGRx                  BGR
  * PIXEL_DEPTH_BGRA       BGRA                  BGR
+ * PIXEL_DEPTH_GRAY_BGR   U8                    BGR
+ *
+ * For PIXEL_DEPTH_GRAY_BGR the frame is converted to grayscale on the fly,
+ * giving the same values as OpenCV 4's cvtColor with COLOR_BGR2GRAY (see
+ * GRAY_SHIFT below).
  *
  * t_stride and f_stride are the strides between lines measured in bytes for
  * t and f respectively.
@@ -41,56 +96,224 @@ typedef struct _SqdiffResult {
  * Returns a struct with the total square difference and count of
  * non-transparent pixels.
  */
-SqdiffResult sqdiff(const uint8_t *t, uint16_t t_stride,
-                    const uint8_t *f, uint16_t f_stride,
-                    uint16_t width_px, uint16_t height_px,
+SqdiffResult sqdiff(const uint8_t *t, uint32_t t_stride,
+                    const uint8_t *f, uint32_t f_stride,
+                    uint32_t width_px, uint32_t height_px,
                     int color_depth)
 {
-    assert(width_px > 0 && height_px > 0);
+    return sqdiff_bounded(t, t_stride, f, f_stride, width_px, height_px,
+                          color_depth, UINT64_MAX, 1);
+}
 
+/* A block of lines, processed by a single thread */
+typedef struct _SqdiffJob {
+    const uint8_t *t;
+    uint32_t t_stride;
+    const uint8_t *f;
+    uint32_t f_stride;
+    uint32_t width_px;
+    uint32_t height_px;
+    int color_depth;
+    uint64_t max_total;
+    /* Set by any thread whose partial total exceeds max_total, so that the
+     * other threads can stop too. */
+    int *stop;
+    SqdiffResult out;
+} SqdiffJob;
+
+static void *sqdiff_lines(void *arg)
+{
+    SqdiffJob *job = arg;
+    const uint8_t *t = job->t, *f = job->f;
+    uint32_t t_stride = job->t_stride, f_stride = job->f_stride;
+    uint32_t width_px = job->width_px;
     SqdiffResult out = {0, 0};
+    uint32_t y;
 
-    switch (color_depth) {
+#define CONTINUE (out.total <= job->max_total && \
+                  !__atomic_load_n(job->stop, __ATOMIC_RELAXED))
+
+    switch (job->color_depth) {
     case PIXEL_DEPTH_U8:
-        assert(f_stride >= width_px && t_stride >= width_px);
-        out.count = width_px * height_px;
-        for (uint16_t y = 0; y < height_px; y++)
+        for (y = 0; y < job->height_px && CONTINUE; y++)
             out.total += sqdiff_U8(
-                t + y * t_stride, f + y * f_stride, width_px);
+                t + (size_t) y * t_stride, f + (size_t) y * f_stride,
+                width_px);
+        out.count = width_px * y;
         break;
     case PIXEL_DEPTH_BGR:
-        assert(f_stride >= width_px * 3 && t_stride >= width_px * 3);
-        out.count = width_px * height_px * 3;
-        for (uint16_t y = 0; y < height_px; y++)
+        for (y = 0; y < job->height_px && CONTINUE; y++)
             out.total += sqdiff_U8(
-                t + y * t_stride, f + y * f_stride, width_px * 3);
+                t + (size_t) y * t_stride, f + (size_t) y * f_stride,
+                width_px * 3);
+        out.count = width_px * y * 3;
         break;
     case PIXEL_DEPTH_BGRx:
-        assert(f_stride >= width_px * 3 && t_stride >= width_px * 4);
-        out.count = width_px * height_px * 3;
-        for (uint16_t y = 0; y < height_px; y++)
+        for (y = 0; y < job->height_px && CONTINUE; y++)
             out.total += sqdiff_BGRx(
-                t + y * t_stride, f + y * f_stride, width_px);
+                t + (size_t) y * t_stride, f + (size_t) y * f_stride,
+                width_px);
+        out.count = width_px * y * 3;
         break;
     case PIXEL_DEPTH_BGRA:
-        assert(f_stride >= width_px * 3 && t_stride >= width_px * 4);
-        out.count = 0;
-        for (uint16_t y = 0; y < height_px; y++)
+        for (y = 0; y < job->height_px && CONTINUE; y++)
             out.total += sqdiff_BGRA(
-                &out.count, t + y * t_stride, f + y * f_stride, width_px);
+                &out.count, t + (size_t) y * t_stride,
+                f + (size_t) y * f_stride, width_px);
         out.count *= 3;
         break;
+    case PIXEL_DEPTH_GRAY_BGR:
+        for (y = 0; y < job->height_px && CONTINUE; y++)
+            out.total += sqdiff_gray_BGR(
+                t + (size_t) y * t_stride, f + (size_t) y * f_stride,
+                width_px);
+        out.count = width_px * y;
+        break;
     default:
         assert(0);
     }
+
+#undef CONTINUE
+
+    if (out.total > job->max_total)
+        __atomic_store_n(job->stop, 1, __ATOMIC_RELAXED);
+    job->out = out;
+    return NULL;
+}
+
+/* Like sqdiff, but:
+ *
+ * - Stops early (at the end of a line) once the total square difference
+ *   exceeds max_total. In that case the returned total is a partial sum,
+ *   which is greater than max_total, and count only includes the lines that
+ *   were processed. Pass UINT64_MAX to disable this.
+ *
+ * - Splits the lines into blocks that are processed in parallel by up to
+ *   n_threads threads. Small images are processed by fewer threads.
+ */
+SqdiffResult sqdiff_bounded(const uint8_t *t, uint32_t t_stride,
+                            const uint8_t *f, uint32_t f_stride,
+                            uint32_t width_px, uint32_t height_px,
+                            int color_depth, uint64_t max_total,
+                            int n_threads)
+{
+    assert(width_px > 0 && height_px > 0);
+    switch (color_depth) {
+    case PIXEL_DEPTH_U8:
+        assert(f_stride >= width_px && t_stride >= width_px);
+        break;
+    case PIXEL_DEPTH_BGR:
+        assert(f_stride >= width_px * 3 && t_stride >= width_px * 3);
+        break;
+    case PIXEL_DEPTH_BGRx:
+    case PIXEL_DEPTH_BGRA:
+        assert(f_stride >= width_px * 3 && t_stride >= width_px * 4);
+        break;
+    case PIXEL_DEPTH_GRAY_BGR:
+        assert(f_stride >= width_px * 3 && t_stride >= width_px);
+        break;
+    default:
+        assert(0);
+    }
+
+    if (sqdiff_U8_impl == NULL)
+        sqdiff_set_simd_level(SIMD_AVX2);
+
+    uint64_t frame_bytes = (uint64_t) width_px * height_px * 3;
+    if (n_threads > (int) (frame_bytes / MIN_BYTES_PER_THREAD))
+        n_threads = frame_bytes / MIN_BYTES_PER_THREAD;
+    if (n_threads > (int) height_px)
+        n_threads = height_px;
+    if (n_threads > MAX_THREADS)
+        n_threads = MAX_THREADS;
+    if (n_threads < 1)
+        n_threads = 1;
+
+    int stop = 0;
+    SqdiffJob jobs[MAX_THREADS];
+    pthread_t threads[MAX_THREADS];
+    int started[MAX_THREADS] = {0};
+    uint32_t y = 0;
+    for (int i = 0; i < n_threads; i++) {
+        uint32_t lines = height_px / n_threads +
+                         ((uint32_t) i < height_px % n_threads ? 1 : 0);
+        SqdiffJob job = {
+            t + (size_t) y * t_stride, t_stride,
+            f + (size_t) y * f_stride, f_stride,
+            width_px, lines, color_depth, max_total, &stop, {0, 0}};
+        jobs[i] = job;
+        y += lines;
+    }
+
+    /* The calling thread processes the first block itself. If we can't start
+     * a thread we process its block in this thread too. */
+    for (int i = 1; i < n_threads; i++)
+        started[i] = (pthread_create(
+            &threads[i], NULL, sqdiff_lines, &jobs[i]) == 0);
+    sqdiff_lines(&jobs[0]);
+
+    SqdiffResult out = jobs[0].out;
+    for (int i = 1; i < n_threads; i++) {
+        if (started[i])
+            pthread_join(threads[i], NULL);
+        else
+            sqdiff_lines(&jobs[i]);
+        out.total += jobs[i].out.total;
+        out.count += jobs[i].out.count;
+    }
     return out;
 }
 
-static uint32_t sqdiff_U8(const unsigned char* a, const unsigned char* b,
-                          uint16_t len)
+/* Sums lines of any length without overflowing the 32-bit accumulators of the
+ * U8 implementations. */
+static uint64_t sqdiff_U8(const unsigned char* a, const unsigned char* b,
+                          uint32_t len)
+{
+    const uint32_t chunk = 65536;
+    uint64_t total = 0;
+    while (len > chunk) {
+        total += sqdiff_U8_impl(a, b, chunk);
+        a += chunk;
+        b += chunk;
+        len -= chunk;
+    }
+    return total + sqdiff_U8_impl(a, b, len);
+}
+
+/* Selects the implementation of the U8 (and BGR) inner loop: the best one
+ * that is supported by this CPU, but no better than `max_level`. Returns the
+ * SimdLevel actually selected.
+ *
+ * This is called automatically the first time you call sqdiff, so you only
+ * need to call it yourself to disable the SIMD implementations (e.g. for
+ * testing).
+ */
+int sqdiff_set_simd_level(int max_level)
+{
+    int level = SIMD_NONE;
+    SqdiffU8Func impl = sqdiff_U8_scalar;
+#ifdef HAVE_X86_SIMD
+    __builtin_cpu_init();
+    if (max_level >= SIMD_SSE2 && __builtin_cpu_supports("sse2")) {
+        level = SIMD_SSE2;
+        impl = sqdiff_U8_sse2;
+    }
+    if (max_level >= SIMD_AVX2 && __builtin_cpu_supports("avx2")) {
+        level = SIMD_AVX2;
+        impl = sqdiff_U8_avx2;
+    }
+#else
+    (void) max_level;
+#endif
+    sqdiff_U8_impl = impl;
+    return level;
+}
+
+static uint32_t sqdiff_U8_scalar(const unsigned char* a,
+                                 const unsigned char* b, uint32_t len)
 {
     uint32_t this_total = 0;
-    for (uint16_t n = 0; n < len; n++) {
+    for (uint32_t n = 0; n < len; n++) {
         int16_t diff = a[n] - b[n];
         uint16_t sqdiff = diff * diff;
         this_total += sqdiff;
@@ -98,11 +321,67 @@ static uint32_t sqdiff_U8(const unsigned char* a, const unsigned char* b,
     return this_total;
 }
 
-static uint32_t sqdiff_BGRx(const unsigned char* t, const unsigned char* f,
-                            uint16_t len)
+#ifdef HAVE_X86_SIMD
+
+/* The SIMD implementations calculate |a - b| as unsigned 8-bit values, widen
+ * them to 16 bits and then use madd to square them and add adjacent pairs into
+ * 32-bit lanes. Any remainder that doesn't fill a whole vector is handled by
+ * the scalar implementation. */
+
+__attribute__((target("sse2")))
+static uint32_t sqdiff_U8_sse2(const unsigned char* a,
+                               const unsigned char* b, uint32_t len)
 {
-    uint32_t this_total = 0;
-    for (uint16_t n = 0; n < len; n++) {
+    const __m128i zero = _mm_setzero_si128();
+    __m128i acc = _mm_setzero_si128();
+    uint32_t n = 0;
+    for (; n + 16 <= len; n += 16) {
+        __m128i va = _mm_loadu_si128((const __m128i*) (a + n));
+        __m128i vb = _mm_loadu_si128((const __m128i*) (b + n));
+        __m128i diff = _mm_or_si128(_mm_subs_epu8(va, vb),
+                                    _mm_subs_epu8(vb, va));
+        __m128i lo = _mm_unpacklo_epi8(diff, zero);
+        __m128i hi = _mm_unpackhi_epi8(diff, zero);
+        acc = _mm_add_epi32(acc, _mm_madd_epi16(lo, lo));
+        acc = _mm_add_epi32(acc, _mm_madd_epi16(hi, hi));
+    }
+    uint32_t lanes[4];
+    _mm_storeu_si128((__m128i*) lanes, acc);
+    return lanes[0] + lanes[1] + lanes[2] + lanes[3] +
+           sqdiff_U8_scalar(a + n, b + n, len - n);
+}
+
+__attribute__((target("avx2")))
+static uint32_t sqdiff_U8_avx2(const unsigned char* a,
+                               const unsigned char* b, uint32_t len)
+{
+    const __m256i zero = _mm256_setzero_si256();
+    __m256i acc = _mm256_setzero_si256();
+    uint32_t n = 0;
+    for (; n + 32 <= len; n += 32) {
+        __m256i va = _mm256_loadu_si256((const __m256i*) (a + n));
+        __m256i vb = _mm256_loadu_si256((const __m256i*) (b + n));
+        __m256i diff = _mm256_or_si256(_mm256_subs_epu8(va, vb),
+                                       _mm256_subs_epu8(vb, va));
+        __m256i lo = _mm256_unpacklo_epi8(diff, zero);
+        __m256i hi = _mm256_unpackhi_epi8(diff, zero);
+        acc = _mm256_add_epi32(acc, _mm256_madd_epi16(lo, lo));
+        acc = _mm256_add_epi32(acc, _mm256_madd_epi16(hi, hi));
+    }
+    uint32_t lanes[8];
+    _mm256_storeu_si256((__m256i*) lanes, acc);
+    return lanes[0] + lanes[1] + lanes[2] + lanes[3] +
+           lanes[4] + lanes[5] + lanes[6] + lanes[7] +
+           sqdiff_U8_sse2(a + n, b + n, len - n);
+}
+
+#endif  /* HAVE_X86_SIMD */
+
+static uint64_t sqdiff_BGRx(const unsigned char* t, const unsigned char* f,
+                            uint32_t len)
+{
+    uint64_t this_total = 0;
+    for (uint32_t n = 0; n < len; n++) {
         int16_t diff_b = t[0] - f[0];
         int16_t diff_g = t[1] - f[1];
         int16_t diff_r = t[2] - f[2];
@@ -114,13 +393,13 @@ static uint32_t sqdiff_BGRx(const unsigned char* t, const unsigned char* f,
     return this_total;
 }
 
-static uint32_t sqdiff_BGRA(uint32_t *count,
+static uint64_t sqdiff_BGRA(uint32_t *count,
                             const unsigned char* t, const unsigned char* f,
-                            uint16_t len)
+                            uint32_t len)
 {
-    uint32_t this_total = 0;
-    uint16_t this_count = 0;
-    for (uint16_t n = 0; n < len; n++) {
+    uint64_t this_total = 0;
+    uint32_t this_count = 0;
+    for (uint32_t n = 0; n < len; n++) {
         int16_t diff_b = t[0] - f[0];
         int16_t diff_g = t[1] - f[1];
         int16_t diff_r = t[2] - f[2];
@@ -137,3 +416,25 @@ static uint32_t sqdiff_BGRA(uint32_t *count,
     *count += this_count;
     return this_total;
 }
+
+/* Fixed-point coefficients used by OpenCV 4's BGR2GRAY conversion of 8-bit
+ * images: gray = (B * 3735 + G * 19235 + R * 9798 + (1 << 14)) >> 15
+ * (Older versions of OpenCV used 14 bits, which can differ by 1.) */
+#define GRAY_SHIFT 15
+#define GRAY_B 3735
+#define GRAY_G 19235
+#define GRAY_R 9798
+
+static uint64_t sqdiff_gray_BGR(const unsigned char* t, const unsigned char* f,
+                                uint32_t len)
+{
+    uint64_t this_total = 0;
+    for (uint32_t n = 0; n < len; n++) {
+        uint8_t gray = (f[0] * GRAY_B + f[1] * GRAY_G + f[2] * GRAY_R +
+                        (1 << (GRAY_SHIFT - 1))) >> GRAY_SHIFT;
+        int16_t diff = t[n] - gray;
+        this_total += (uint32_t) (diff * diff);
+        f += 3;
+    }
+    return this_total;
+}
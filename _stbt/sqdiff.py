@@ -4,6 +4,7 @@ from __future__ import print_function
 from __future__ import absolute_import
 from builtins import *  # pylint:disable=redefined-builtin,unused-wildcard-import,wildcard-import,wrong-import-order
 import ctypes
+import multiprocessing
 import os
 
 import numpy
@@ -23,61 +24,132 @@ class _SqdiffResult(ctypes.Structure):
                 ("count", ctypes.c_uint32)]
 
 
-# SqdiffResult sqdiff(const uint8_t *t, uint16_t t_stride,
-#                     const uint8_t *f, uint16_t f_stride,
-#                     uint16_t width_px, uint16_t height_px,
+# SqdiffResult sqdiff(const uint8_t *t, uint32_t t_stride,
+#                     const uint8_t *f, uint32_t f_stride,
+#                     uint32_t width_px, uint32_t height_px,
 #                     int color_depth)
 
 _libstbt.sqdiff.restype = _SqdiffResult
 _libstbt.sqdiff.argtypes = [
-    ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint16,
-    ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint16,
-    ctypes.c_uint16, ctypes.c_uint16,
+    ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint32,
+    ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint32,
+    ctypes.c_uint32, ctypes.c_uint32,
     ctypes.c_int
 ]
 
+# SqdiffResult sqdiff_bounded(const uint8_t *t, uint32_t t_stride,
+#                             const uint8_t *f, uint32_t f_stride,
+#                             uint32_t width_px, uint32_t height_px,
+#                             int color_depth, uint64_t max_total,
+#                             int n_threads)
+#
+# Note that ctypes releases the GIL while calling into the library, so other
+# python threads can run while this is in progress.
 
+_libstbt.sqdiff_bounded.restype = _SqdiffResult
+_libstbt.sqdiff_bounded.argtypes = _libstbt.sqdiff.argtypes + [
+    ctypes.c_uint64, ctypes.c_int]
+
+UINT64_MAX = 2 ** 64 - 1
+
+# int sqdiff_set_simd_level(int max_level)
+_libstbt.sqdiff_set_simd_level.restype = ctypes.c_int
+_libstbt.sqdiff_set_simd_level.argtypes = [ctypes.c_int]
+
+SIMD_NONE = 0
+SIMD_SSE2 = 1
+SIMD_AVX2 = 2
+
+
+PIXEL_DEPTH_U8 = 0
 PIXEL_DEPTH_BGR = 1
 PIXEL_DEPTH_BGRx = 2
 PIXEL_DEPTH_BGRA = 3
+PIXEL_DEPTH_GRAY_BGR = 4
 
+# (template pixel stride, template channels, frame channels) -> color_depth
 COLOR_DEPTH_LOOKUP = {
-    (3, 3): PIXEL_DEPTH_BGR,
-    (4, 3): PIXEL_DEPTH_BGRx,
-    (4, 4): PIXEL_DEPTH_BGRA,
+    (1, 1, 1): PIXEL_DEPTH_U8,
+    (3, 3, 3): PIXEL_DEPTH_BGR,
+    (4, 3, 3): PIXEL_DEPTH_BGRx,
+    (4, 4, 3): PIXEL_DEPTH_BGRA,
+    (1, 1, 3): PIXEL_DEPTH_GRAY_BGR,
 }
 
 
-def sqdiff(template, frame):
+def sqdiff(template, frame, max_total=None):
+    """Returns the total square difference between `template` and `frame`, and
+    the number of values that were compared (excluding transparent pixels of
+    `template`).
+
+    `template` and `frame` can be 2D (grayscale) or 3D arrays. If `template`
+    is grayscale and `frame` is BGR, `frame` is converted to grayscale first.
+
+    If `max_total` is specified, we may stop early once the total exceeds
+    `max_total`. In that case the returned total is a partial sum (greater than
+    `max_total`) and the count only covers the lines that were compared.
+    """
     if template.shape[:2] != frame.shape[:2]:
         raise ValueError("Template and frame must be the same size")
+    if template.ndim == 2:
+        template = template[:, :, numpy.newaxis]
+    if frame.ndim == 2:
+        frame = frame[:, :, numpy.newaxis]
     try:
-        return _sqdiff_c(template, frame)
+        return _sqdiff_c(template, frame, max_total)
     except NotImplementedError as e:
         debug("sqdiff Missed fast-path: %s" % e)
         return _sqdiff_numpy(template, frame)
 
 
-def _sqdiff_c(template, frame):
+def _sqdiff_threads():
+    from .config import get_config
+    n = get_config("match", "sqdiff_threads", 0, type_=int)
+    if n <= 0:
+        n = multiprocessing.cpu_count()
+    return n
+
+
+def _sqdiff_c(template, frame, max_total=None, n_threads=None):
     if template.dtype != numpy.uint8 or frame.dtype != numpy.uint8:
         raise NotImplementedError("dtype must be uint8")
 
-    if frame.strides[2] != 1 or template.strides[2] != 1 or \
-            frame.strides[1] != 3:
+    # The stride of the last dimension doesn't matter for single-channel
+    # images (it's 0 for `gray[:, :, numpy.newaxis]`).
+    if (frame.shape[2] > 1 and frame.strides[2] != 1) or \
+            (template.shape[2] > 1 and template.strides[2] != 1) or \
+            frame.strides[1] != frame.shape[2]:
         raise NotImplementedError("Pixel data must be contiguous")
+    if frame.strides[0] < 0 or template.strides[0] < 0:
+        raise NotImplementedError("Negative strides aren't supported")
 
-    color_depth = COLOR_DEPTH_LOOKUP[(template.strides[1], template.shape[2])]
+    try:
+        color_depth = COLOR_DEPTH_LOOKUP[
+            (template.strides[1], template.shape[2], frame.shape[2])]
+    except KeyError:
+        raise NotImplementedError(
+            "Unsupported template %r / frame %r layout" % (
+                template.shape, frame.shape))
 
     t = template.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8))
     f = frame.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8))
 
-    out = _libstbt.sqdiff(t, template.strides[0],
-                          f, frame.strides[0],
-                          template.shape[1], template.shape[0], color_depth)
+    if max_total is None:
+        max_total = UINT64_MAX
+    if n_threads is None:
+        n_threads = _sqdiff_threads()
+
+    out = _libstbt.sqdiff_bounded(t, template.strides[0],
+                                  f, frame.strides[0],
+                                  template.shape[1], template.shape[0],
+                                  color_depth, max(0, int(max_total)),
+                                  n_threads)
     return out.total, out.count
 
 
 def _sqdiff_numpy(template, frame):
+    if template.shape[2] == 1 and frame.shape[2] == 3:
+        frame = _bgr_to_gray(frame)[:, :, numpy.newaxis]
     template = template.astype(numpy.int64)
     frame = frame.astype(numpy.int64)
     if template.shape[2] == 4:
@@ -88,6 +160,13 @@ def _sqdiff_numpy(template, frame):
     return numpy.sum(x), x.size
 
 
+def _bgr_to_gray(frame):
+    # Same as `sqdiff_gray_BGR` in sqdiff.c
+    b, g, r = [frame[:, :, i].astype(numpy.uint32) for i in range(3)]
+    return ((b * 3735 + g * 19235 + r * 9798 + (1 << 14)) >> 15).astype(
+        numpy.uint8)
+
+
 def _random_template(size=(1280, 720)):
     tsize = (numpy.random.randint(1, size[0] + 1),
              numpy.random.randint(1, size[1] + 1))
@@ -145,6 +224,79 @@ def test_sqdiff_c_numpy_equivalence():
                     _sqdiff_c(t, frame_cropped))
 
 
+def test_sqdiff_grayscale():
+    import cv2
+
+    for _ in range(20):
+        frame_cropped, template, _ = _random_template((200, 100))
+        gray_template = _bgr_to_gray(template)
+        gray_frame = _bgr_to_gray(frame_cropped)
+        assert numpy.abs(
+            cv2.cvtColor(frame_cropped, cv2.COLOR_BGR2GRAY).astype(int) -
+            gray_frame).max() <= 1
+        expected = _sqdiff_numpy(gray_template[:, :, numpy.newaxis],
+                                 gray_frame[:, :, numpy.newaxis])
+        assert expected == _sqdiff_numpy(gray_template[:, :, numpy.newaxis],
+                                         frame_cropped)
+        for t, f in [(gray_template, gray_frame),
+                     (gray_template[:, :, numpy.newaxis],
+                      gray_frame[:, :, numpy.newaxis]),
+                     (gray_template, frame_cropped)]:
+            assert expected == sqdiff(t, f)
+        assert expected == _sqdiff_c(gray_template[:, :, numpy.newaxis],
+                                     frame_cropped)
+
+
+def test_sqdiff_simd_equivalence():
+    try:
+        for level in (SIMD_NONE, SIMD_SSE2, SIMD_AVX2):
+            if _libstbt.sqdiff_set_simd_level(level) != level:
+                continue  # Not supported by this CPU
+            for _ in range(20):
+                frame_cropped, template, _ = _random_template((200, 100))
+                assert (_sqdiff_numpy(template, frame_cropped) ==
+                        _sqdiff_c(template, frame_cropped))
+    finally:
+        _libstbt.sqdiff_set_simd_level(SIMD_AVX2)
+
+
+def test_sqdiff_bounded():
+    f = numpy.zeros((720, 1280, 3), dtype=numpy.uint8)
+    t = numpy.zeros((720, 1280, 3), dtype=numpy.uint8)
+    t[::2, :, :] = 1  # A total of 1280 * 3 for every other line
+
+    full = (360 * 1280 * 3, 720 * 1280 * 3)
+    assert _sqdiff_c(t, f, n_threads=1) == full
+    assert _sqdiff_c(t, f, max_total=full[0], n_threads=1) == full
+    # Stops after the first line that takes it over the maximum:
+    assert _sqdiff_c(t, f, max_total=0, n_threads=1) == (1280 * 3, 1280 * 3)
+    assert (_sqdiff_c(t, f, max_total=1280 * 3, n_threads=1) ==
+            (2 * 1280 * 3, 3 * 1280 * 3))
+
+    tt = numpy.zeros((720, 1280, 4), dtype=numpy.uint8)
+    tt[:, :, :3] = t
+    tt[:, :640, 3] = 255
+    assert _sqdiff_c(tt, f, max_total=0, n_threads=1) == (640 * 3, 640 * 3)
+
+    # With several threads each thread stops after its first line:
+    total, count = _sqdiff_c(t, f, max_total=0, n_threads=4)
+    assert 1280 * 3 <= total < full[0]
+    assert count < full[1]
+
+
+def test_sqdiff_threads():
+    # 4K, and wider than the old limit of 65535 bytes per line:
+    for shape in [(2160, 3840, 3), (100, 30000, 3)]:
+        f = numpy.random.randint(0, 256, shape, dtype=numpy.uint8)
+        t = numpy.random.randint(0, 256, shape, dtype=numpy.uint8)
+        tt = numpy.random.randint(0, 256, shape[:2] + (4,), dtype=numpy.uint8)
+        for template in (t, tt, tt[:, :, :3]):
+            expected = _sqdiff_c(template, f, n_threads=1)
+            for n in (2, 3, 8):
+                assert _sqdiff_c(template, f, n_threads=n) == expected
+        assert expected == _sqdiff_numpy(tt[:, :, :3], f)
+
+
 def _make_sqdiff_numba():
     # numba implementation included for the purposes of comparison.
     try:
@@ -190,6 +342,7 @@ def _measure_performance():
 
     _sqdiff_numba = _make_sqdiff_numba()
 
+    print("SIMD level: %i" % _libstbt.sqdiff_set_simd_level(SIMD_AVX2))
     print("All times in ms                         numpy\tnumba")
     print("type    \tnumpy\tnumba\tC\tspeedup\tspeedup\tsize\talignment")
     for _ in range(100):
@@ -57,6 +57,21 @@ def video(args, dut):
                              save_png=(args.save_screenshot == 'always'))
 
 
+@contextmanager
+def image_processing_cache():
+    """Enables the image-processing cache for the duration of the test, if
+    ``stbt_run = true`` is set in the ``[cache]`` section of the configuration
+    file. See `stbt.memoize`.
+    """
+    from _stbt import imgproc_cache
+    from _stbt.config import get_config
+    if get_config("cache", "stbt_run", False, type_=bool):
+        with imgproc_cache.cache():
+            yield
+    else:
+        yield
+
+
 def _import_by_filename(filename_):
     from importlib import import_module
     import_dir, import_name = find_import_name(filename_)
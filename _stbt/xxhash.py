@@ -50,6 +50,20 @@ _libxxhash.XXH64_update.restype = _XXH_errorcode
 _libxxhash.XXH64_digest.argtypes = [_XXH64_state_t]
 _libxxhash.XXH64_digest.restype = _XXH64_hash_t
 
+_libstbt = ctypes.CDLL(
+    os.path.dirname(os.path.abspath(__file__)) + "/libstbt.so")
+
+# int xxh64_update_strided(
+#     XxhUpdateFunc update, void *state, const uint8_t *data,
+#     size_t n_rows, size_t row_bytes, ptrdiff_t row_stride)
+_libstbt.xxh64_update_strided.argtypes = [
+    ctypes.c_void_p, _XXH64_state_t, ctypes.c_void_p,
+    ctypes.c_size_t, ctypes.c_size_t, ctypes.c_ssize_t]
+_libstbt.xxh64_update_strided.restype = _XXH_errorcode
+
+_XXH64_update_address = ctypes.cast(
+    _libxxhash.XXH64_update, ctypes.c_void_p).value
+
 
 class Xxhash64(object):
     __slots__ = ["_state"]
@@ -79,6 +93,29 @@ class Xxhash64(object):
         _libxxhash.XXH64_update(
             self._state, address, ctypes.c_size_t(length.value))
 
+    def update_array(self, a):
+        """Hashes the contents of numpy array `a` in C (row-major) order.
+
+        Gives the same result as ``update(numpy.ascontiguousarray(a).data)``,
+        but if the rows of `a` are contiguous in memory (for example a crop of
+        a larger frame) we hash them in place instead of making a copy.
+        """
+        import numpy
+        if a.ndim < 2 or a.size == 0 or a.flags.c_contiguous:
+            self.update(numpy.ascontiguousarray(a).data)
+            return
+        row = a[0]
+        if not row.flags.c_contiguous:
+            # The rows themselves are strided, e.g. a single channel of a BGR
+            # image:
+            self.update(numpy.ascontiguousarray(a).data)
+            return
+        n_rows = a.shape[0]
+        row_bytes = row.nbytes
+        _libstbt.xxh64_update_strided(
+            _XXH64_update_address, self._state, a.ctypes.data,
+            n_rows, row_bytes, a.strides[0])
+
     def digest(self):
         return struct.pack(">Q", _libxxhash.XXH64_digest(self._state))
 
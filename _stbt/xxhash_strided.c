@@ -0,0 +1,34 @@
+#include <stddef.h>
+#include <stdint.h>
+
+/* Signature of XXH64_update from libxxhash.  We're passed a pointer to it
+ * rather than linking against libxxhash so that libstbt can be built without
+ * the vendored xxHash sources. */
+typedef int (*XxhUpdateFunc)(void *state, const void *input, size_t length);
+
+int xxh64_update_strided(
+    XxhUpdateFunc update, void *state, const uint8_t *data,
+    size_t n_rows, size_t row_bytes, ptrdiff_t row_stride);
+
+/* Hashes the rows of a 2D (or row-major 3D) buffer in place, so that callers
+ * don't need to copy a cropped image into a contiguous buffer first.  Gives the
+ * same result as hashing the rows one after another.
+ *
+ * Returns 0 on success, or the error returned by `update`. */
+int xxh64_update_strided(
+    XxhUpdateFunc update, void *state, const uint8_t *data,
+    size_t n_rows, size_t row_bytes, ptrdiff_t row_stride)
+{
+    size_t y;
+    int err;
+
+    if (row_stride == (ptrdiff_t) row_bytes)
+        return update(state, data, n_rows * row_bytes);
+
+    for (y = 0; y < n_rows; y++) {
+        err = update(state, data + (ptrdiff_t) y * row_stride, row_bytes);
+        if (err)
+            return err;
+    }
+    return 0;
+}
@@ -32,6 +32,8 @@ from _stbt.config import (
     get_config)
 from _stbt.frameobject import (
     FrameObject)
+from _stbt.imgproc_cache import (
+    memoize)
 from _stbt.imgutils import (
     crop,
     Frame)
@@ -41,12 +43,14 @@ from _stbt.match import (
     ConfirmMethod,
     match,
     match_all,
+    match_many,
     MatchMethod,
     MatchParameters,
     MatchResult,
     MatchTimeout,
     Position,
-    wait_for_match)
+    wait_for_match,
+    wait_for_match_many)
 from _stbt.motion import (
     detect_motion,
     MotionResult,
@@ -55,9 +59,11 @@ from _stbt.motion import (
 from _stbt.ocr import (
     match_text,
     ocr,
+    ocr_many,
     OcrEngine,
     OcrMode,
-    TextMatchResult)
+    TextMatchResult,
+    wait_for_text)
 from _stbt.transition import (
     press_and_wait,
     TransitionStatus,
@@ -86,15 +92,18 @@ __all__ = [
     "load_image",
     "match",
     "match_all",
+    "match_many",
     "match_text",
     "MatchMethod",
     "MatchParameters",
     "MatchResult",
     "MatchTimeout",
+    "memoize",
     "MotionResult",
     "MotionTimeout",
     "NoVideo",
     "ocr",
+    "ocr_many",
     "OcrEngine",
     "OcrMode",
     "Position",
@@ -109,7 +118,9 @@ __all__ = [
     "UITestError",
     "UITestFailure",
     "wait_for_match",
+    "wait_for_match_many",
     "wait_for_motion",
+    "wait_for_text",
     "wait_for_transition_to_end",
     "wait_until",
 ]
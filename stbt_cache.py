@@ -0,0 +1,66 @@
+#!/usr/bin/python
+
+"""
+Copyright 2026 stb-tester.com Ltd.
+License: LGPL v2.1 or (at your option) any later version (see
+https://github.com/stb-tester/stb-tester/blob/master/LICENSE for details).
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from builtins import *  # pylint:disable=redefined-builtin,unused-wildcard-import,wildcard-import,wrong-import-order
+
+import argparse
+import os
+import sys
+import time
+
+from _stbt import imgproc_cache
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.prog = "stbt cache"
+    parser.description = """Inspect the cache of image-processing results
+        (used by `stbt auto-selftest` and by functions decorated with
+        `imgproc_cache.memoize`)."""
+    parser.add_argument(
+        "--cache", metavar="FILE", default=imgproc_cache.default_filename(),
+        help="The cache database (default: %(default)s)")
+    parser.add_argument(
+        "command", choices=["stats"], help=(
+            "stats: Print the size of the cache and the number of entries "
+            "for each memoized function"))
+    args = parser.parse_args(argv[1:])
+
+    if not os.path.exists(args.cache):
+        sys.stderr.write("stbt cache: error: No cache at %s\n" % args.cache)
+        return 1
+
+    if args.command == "stats":
+        print_stats(imgproc_cache.file_stats(args.cache))
+    return 0
+
+
+def print_stats(stats):
+    print("Cache: %s" % stats["filename"])
+    print("Size: %s of %s (%.0f%%)" % (
+        _format_mb(stats["used_bytes"]), _format_mb(stats["map_size"]),
+        100. * stats["used_bytes"] / stats["map_size"]))
+    print("")
+    print("%-50s %8s %10s  %s" % ("Function", "Entries", "Size", "Last used"))
+    for name, f in stats["functions"].items():
+        print("%-50s %8i %10s  %s" % (
+            name or "(unknown)", f["entries"], _format_mb(f["bytes"]),
+            time.strftime("%Y-%m-%d %H:%M:%S",
+                          time.localtime(f["last_used"]))
+            if f["last_used"] else "-"))
+
+
+def _format_mb(nbytes):
+    return "%.1f MB" % (nbytes / 1024 / 1024)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
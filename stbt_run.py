@@ -17,7 +17,8 @@ import sys
 
 import _stbt.core
 import stbt
-from _stbt.stbt_run import (load_test_function,
+from _stbt import imgproc_cache
+from _stbt.stbt_run import (image_processing_cache, load_test_function,
                             sane_unicode_and_exception_handling, video)
 
 
@@ -47,9 +48,16 @@ def main(argv):
         "%s: %s" % (k, v) for k, v in args.__dict__.items()]))
 
     dut = _stbt.core.new_device_under_test_from_config(args)
-    with sane_unicode_and_exception_handling(args.script), video(args, dut):
-        test_function = load_test_function(args.script, args.args)
-        test_function.call()
+    try:
+        with sane_unicode_and_exception_handling(args.script), \
+                video(args, dut), image_processing_cache():
+            test_function = load_test_function(args.script, args.args)
+            test_function.call()
+    finally:
+        # Only if the test used the image-processing cache:
+        cache_stats = imgproc_cache.format_stats()
+        if cache_stats:
+            sys.stderr.write("Image-processing cache:\n" + cache_stats)
 
 
 if __name__ == '__main__':
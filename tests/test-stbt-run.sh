@@ -360,3 +360,36 @@ test_that_stbt_run_doesnt_import_unrelated_files() {
         fail "test.py was run but I asked for test2.py"
     fi
 }
+
+test_that_stbt_run_prints_image_processing_cache_stats() {
+    export XDG_CACHE_HOME="$PWD/cache"
+    cat > test.py <<-EOF
+	import stbt
+	stbt.ocr(stbt.load_image("$testdir/ocr/small.png"))
+	EOF
+    stbt run -v test.py &> test.log || fail "Test failed"
+    assert ! grep -q "Image-processing cache" test.log
+
+    set_config cache.stbt_run "true" &&
+    stbt run -v test.py &> test.log || fail "Test failed"
+    assert grep -q "Image-processing cache:" test.log
+    assert grep -qE "_tesseract_subprocess +0 +1 " test.log
+}
+
+test_that_stbt_run_caches_memoized_functions_across_runs() {
+    export XDG_CACHE_HOME="$PWD/cache"
+    set_config cache.stbt_run "true" &&
+    cat > test.py <<-EOF
+	import stbt
+	@stbt.memoize()
+	def expensive(n):
+	    print("expensive(%i) called" % n)
+	    return n * 2
+	assert expensive(21) == 42
+	EOF
+    stbt run -v test.py &> test.log || fail "Test failed"
+    assert grep -q "expensive(21) called" test.log
+    stbt run -v test.py &> test.log || fail "Test failed"
+    assert ! grep -q "expensive(21) called" test.log
+    assert grep -qE "expensive +1 +0 " test.log
+}
@@ -45,6 +45,16 @@ def test_load_image_with_unicode_filename():
     assert stbt.load_image(u"R\xf6thlisberger.png") is not None
 
 
+def test_that_load_image_returns_a_new_copy_each_time():
+    a = stbt.load_image("action-panel.png")
+    b = stbt.load_image("action-panel.png")
+    assert a is not b
+    assert numpy.array_equal(a, b)
+    assert a.flags.writeable
+    a[0, 0] = 255 - a[0, 0]
+    assert not numpy.array_equal(stbt.load_image("action-panel.png"), a)
+
+
 def test_crop():
     f = stbt.load_image("action-panel.png")
     cropped = stbt.crop(f, stbt.Region(x=1045, y=672, right=1081, bottom=691))
@@ -57,10 +57,10 @@ def test_matchresult_region_when_first_pyramid_level_fails_to_match():
     stbt.MatchMethod.SQDIFF,
     stbt.MatchMethod.SQDIFF_NORMED,
 ])
-def test_that_match_rejects_greyscale_array(match_method):
-    grey = cv2.cvtColor(stbt.load_image("black.png"), cv2.COLOR_BGR2GRAY)
+def test_that_match_rejects_colour_image_with_greyscale_frame(match_method):
+    grey_frame = cv2.cvtColor(black(), cv2.COLOR_BGR2GRAY)
     with pytest.raises(ValueError):
-        stbt.match(grey, frame=black(),
+        stbt.match("black.png", frame=grey_frame,
                    match_parameters=mp(match_method=match_method))
 
 
@@ -115,6 +115,32 @@ def test_matching_greyscale_array_with_greyscale_frame(match_method):
         match_parameters=mp(match_method=match_method))
 
 
+@pytest.mark.parametrize("match_method", [
+    stbt.MatchMethod.SQDIFF,
+    stbt.MatchMethod.SQDIFF_NORMED,
+])
+def test_matching_greyscale_array_with_colour_frame(match_method):
+    frame = stbt.load_image("videotestsrc-full-frame.png")
+    grey = cv2.cvtColor(stbt.load_image("videotestsrc-redblue.png"),
+                        cv2.COLOR_BGR2GRAY)
+    m = stbt.match(grey, frame=frame,
+                   match_parameters=mp(match_method=match_method))
+    assert m
+    assert m.region == stbt.match("videotestsrc-redblue.png", frame=frame,
+                                  match_parameters=mp(match_method=match_method)
+                                  ).region
+
+    # Same size as the frame: `sqdiff` compares the greyscale reference image
+    # with the colour frame directly.
+    grey_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    m = stbt.match(grey_frame, frame=frame,
+                   match_parameters=mp(match_method=match_method))
+    assert m
+    assert m.first_pass_result == 1.0
+    assert not stbt.match(255 - grey_frame, frame=frame,
+                          match_parameters=mp(match_method=match_method))
+
+
 @pytest.mark.parametrize("filename", [
     "videotestsrc-greyscale.png",
     "videotestsrc-greyscale-alpha.png",
@@ -303,6 +329,95 @@ def test_match_all_with_an_image_that_matches_everywhere(match_method):
     assert matches == expected_matches
 
 
+def test_that_match_all_order_is_deterministic(monkeypatch):
+    # `match_all` confirms candidate matches in parallel; the results must be
+    # in the same order as when they are confirmed serially.
+    import _stbt.match
+
+    def match_all():
+        return [m.region for m in stbt.match_all(
+            "repeating-pattern.png",
+            frame=stbt.load_image("repeating-pattern-full-frame.png"))]
+
+    parallel = match_all()
+
+    class SerialPool(object):
+        class Result(object):
+            def __init__(self, value):
+                self.value = value
+
+            def get(self):
+                return self.value
+
+        def apply_async(self, func, args):
+            return self.Result(func(*args))
+
+    monkeypatch.setattr(_stbt.match, "_confirm_pool", SerialPool)
+    assert parallel == match_all()
+    assert len(parallel) == 300
+
+
+def test_that_match_all_only_confirms_the_candidates_it_needs(monkeypatch):
+    import _stbt.match
+    calls = []
+    orig_confirm_match = _stbt.match._confirm_match
+
+    def _confirm_match(*args, **kwargs):
+        calls.append(args[1])
+        return orig_confirm_match(*args, **kwargs)
+
+    monkeypatch.setattr(_stbt.match, "_confirm_match", _confirm_match)
+    matches = stbt.match_all(
+        "repeating-pattern.png",
+        frame=stbt.load_image("repeating-pattern-full-frame.png"))
+    next(matches)
+    next(matches)
+    assert len(calls) <= 2 + _stbt.match._CONFIRM_THREADS
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_that_find_peaks_is_equivalent_to_greedy_search(seed):
+    from _stbt.match import (
+        _exclude_from_heatmap, _find_best_match_position, _find_peaks)
+
+    rng = numpy.random.RandomState(seed)
+    heatmap = rng.randint(0, 20, (100, 150)).astype(numpy.float32)
+    scale = 100.
+    threshold = 0.9
+    template_size = (7, 5)
+
+    expected = []
+    h = heatmap.copy()
+    while True:
+        matched, position, certainty = _find_best_match_position(
+            h, scale, threshold, 0)
+        if not matched:
+            break
+        expected.append((position, certainty))
+        _exclude_from_heatmap(
+            h, scale, stbt.Region(*position, width=7, height=5))
+
+    peaks, last = _find_peaks(heatmap, scale, threshold, template_size,
+                              exclude=expected[0][0])
+    assert peaks == expected[1:]
+    assert last == (position, certainty)
+
+
+def test_that_find_peaks_excludes_the_match_already_found():
+    from _stbt.match import _find_peaks
+
+    # Two equally good, non-overlapping matches:
+    heatmap = numpy.full((20, 40), 100, dtype=numpy.float32)
+    heatmap[5, 5] = 0
+    heatmap[5, 25] = 0
+
+    # Whichever of them was found first isn't returned again:
+    for first, other in [((5, 5), (25, 5)), ((25, 5), (5, 5))]:
+        peaks, _ = _find_peaks(heatmap, 100., 0.9, (7, 5),
+                               exclude=stbt.Position(*first))
+        assert peaks == [(stbt.Position(*other), 1.0)]
+
+
 def test_that_sqdiff_matches_black_images():
     black_reference = black(10, 10)
     almost_black_reference = black(10, 10, value=1)
@@ -416,6 +531,105 @@ def test_that_match_fast_path_is_equivalent():
             assert orig_m.image == fast_m.image
 
 
+def test_that_match_early_exit_only_affects_non_matches():
+    from _stbt.match import _match
+    frame = stbt.load_image("videotestsrc-full-frame.png")
+    for reference in [frame, numpy.flipud(frame), frame // 2 + 1]:
+        exact = stbt.match(reference, frame)
+        early = _match(reference, frame, None, stbt.Region.ALL,
+                       early_exit=True)
+        assert exact.match == early.match
+        if exact.match:
+            assert exact.first_pass_result == early.first_pass_result
+        else:
+            assert exact.first_pass_result <= early.first_pass_result < 0.98
+
+
+@pytest.mark.parametrize("match_method", [
+    stbt.MatchMethod.SQDIFF,
+    stbt.MatchMethod.SQDIFF_NORMED,
+])
+def test_that_match_many_is_equivalent_to_match(match_method):
+    frame = stbt.load_image("buttons.png")
+    images = ["button.png", "black.png", "buttons.png",
+              stbt.load_image("button.png")[:20, :20]]
+    results = stbt.match_many(images, frame=frame,
+                              match_parameters=mp(match_method=match_method))
+    assert len(results) == len(images)
+    for image, result in zip(images, results):
+        expected = stbt.match(image, frame=frame,
+                              match_parameters=mp(match_method=match_method))
+        assert result.match == expected.match
+        assert result.region == expected.region
+        assert result.first_pass_result == expected.first_pass_result
+        assert (result.frame == frame).all()
+
+
+def test_that_wait_for_match_checks_the_previous_position_first(
+        monkeypatch):
+    import _stbt.match
+    regions = []
+    orig_match = _stbt.match._match
+
+    def _match(image, frame, match_parameters, region, early_exit=False):
+        regions.append(region)
+        return orig_match(image, frame, match_parameters, region, early_exit)
+
+    monkeypatch.setattr(_stbt.match, "_match", _match)
+
+    frame = stbt.load_image("buttons.png")
+    res = stbt.wait_for_match("button.png", consecutive_matches=3,
+                              frames=_frames(frame, frame, frame))
+    assert res.match
+    assert regions == [stbt.Region.ALL, res.region, res.region]
+
+    # Falls back to searching the whole region when it has moved:
+    del regions[:]
+    moved = numpy.roll(frame, 10, axis=1)
+    res2 = stbt.wait_for_match("button.png", consecutive_matches=2,
+                               frames=_frames(frame, moved, moved, moved))
+    assert res2.region == res.region.translate(x=10)
+    assert regions == [stbt.Region.ALL, res.region, stbt.Region.ALL,
+                       res2.region, res2.region]
+
+
+def test_that_match_all_caches_one_grayscale_frame():
+    from _stbt.imgutils import _derived_images
+    frame = stbt.load_image("buttons.png").copy()
+    frame.flags.writeable = False
+    assert len(list(stbt.match_all("button.png", frame=frame))) > 1
+
+    # One grayscale conversion of the whole frame for confirming all the
+    # candidates, rather than one per candidate evicting the frame's pyramid:
+    names = [key[1][0] for key in list(_derived_images._entries)  # pylint:disable=protected-access
+             if key[0] == id(frame)]
+    assert sorted(names) == ["gray", "pyramid"]
+
+
+def _frames(*frames):
+    for i, f in enumerate(frames):
+        yield stbt.Frame(f, time=float(i))
+
+
+def test_wait_for_match_many():
+    import time
+
+    def fake_frames():
+        for f in ["black-full-frame.png", "black-full-frame.png",
+                  "buttons.png"]:
+            yield stbt.Frame(stbt.load_image(f), time=time.time())
+
+    results = stbt.wait_for_match_many(["videotestsrc-redblue.png",
+                                        "button.png"],
+                                       frames=fake_frames())
+    assert [bool(r) for r in results] == [False, True]
+    assert results[1].frame.shape == stbt.load_image("buttons.png").shape
+
+    with pytest.raises(stbt.MatchTimeout):
+        stbt.wait_for_match_many(["videotestsrc-redblue.png", "button.png"],
+                                 frames=fake_frames(), consecutive_matches=2)
+
+
 def test_merge_regions():
     regions = [stbt.Region(*x) for x in [
         (153, 156, 16, 4), (121, 155, 25, 5), (14, 117, 131, 32),
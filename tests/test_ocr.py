@@ -218,6 +218,134 @@ def test_that_text_location_is_recognised():
         yield (test, text, region, False)
 
 
+def test_find_text_regions():
+    from _stbt.ocr import _find_text_regions
+    frame = load_image("ocr/menu.png")
+    regions = _find_text_regions(frame)
+    # Much less than the whole frame:
+    assert sum(r.width * r.height for r in regions) < 0.1 * 1280 * 720
+
+    # Each menu item is in exactly one region, which doesn't include the
+    # outline of the button:
+    for _, region, _ in iterate_menu():
+        found = [r for r in regions if stbt.Region.intersect(r, region)]
+        assert len(found) == 1
+        assert region.contains(found[0])
+
+    assert _find_text_regions(frame, stbt.Region(1280, 0, 1280, 720)) == []
+    assert _find_text_regions(frame, stbt.Region(0, 300, 1280, 80)) == []
+
+
+def test_match_text_with_find_text_regions():
+    frame = load_image("ocr/menu.png")
+    with temporary_config({"ocr.find_text_regions": "true"}):
+        for text, region, multiline in iterate_menu():
+            if multiline:
+                continue
+            result = stbt.match_text(text, frame=frame)
+            assert result
+            assert region.contains(result.region)  # pylint:disable=no-member
+        assert not stbt.match_text(u"Noodle Soup", frame=frame)
+
+
+def _frames(*frames):
+    for i, f in enumerate(frames):
+        yield stbt.Frame(f, time=float(i))
+
+
+def test_wait_for_text():
+    import numpy
+    menu = load_image("ocr/menu.png")
+    blank = numpy.full_like(menu, 255)
+
+    res = stbt.wait_for_text("Onion Bhaji", frames=_frames(blank, menu))
+    assert res.match
+    assert res.time == 1.0
+    assert stbt.Region(40, 120, 240, 80).contains(res.region)
+
+    res = stbt.wait_for_text("Onion Bhaji", consecutive_matches=2,
+                             frames=_frames(menu, blank, menu, menu))
+    assert res.time == 3.0
+
+    with pytest.raises(stbt.MatchTimeout):
+        stbt.wait_for_text("Noodle Soup", frames=_frames(menu, blank))
+
+
+def test_that_wait_for_text_reuses_the_text_regions(monkeypatch):
+    import _stbt.ocr
+    find_calls = []
+    ocr_regions = []
+    orig_find = _stbt.ocr._find_text_regions
+    orig_tesseract = _stbt.ocr._tesseract
+
+    def _find_text_regions(frame, region=stbt.Region.ALL):
+        find_calls.append(region)
+        return orig_find(frame, region)
+
+    def _tesseract(frame, region, *args):
+        ocr_regions.append(region)
+        return orig_tesseract(frame, region, *args)
+
+    monkeypatch.setattr(_stbt.ocr, "_find_text_regions", _find_text_regions)
+    monkeypatch.setattr(_stbt.ocr, "_tesseract", _tesseract)
+
+    menu = load_image("ocr/menu.png")
+    text_regions = orig_find(menu)
+    with temporary_config({"ocr.find_text_regions": "true"}):
+        res = stbt.wait_for_text("Kerala Prawn Curry", consecutive_matches=3,
+                                 frames=_frames(menu, menu, menu))
+    assert res.match
+    assert len(find_calls) == 1
+
+    # The first frame is read line by line until we find the text; after
+    # that we look where we found it first:
+    box = [r for r in text_regions if r.contains(res.region)][0]
+    n = text_regions.index(box) + 1
+    assert ocr_regions == text_regions[:n] + [box, box]
+
+
+def test_that_wait_for_text_looks_where_it_found_the_text_first(monkeypatch):
+    import numpy
+    import _stbt.ocr
+    frame = numpy.zeros((240, 320, 3), dtype=numpy.uint8)
+    text_region = stbt.Region(100, 50, right=160, bottom=70)
+    ocr_regions = []
+
+    def _tesseract(frame, region, *_):
+        region = stbt.Region.intersect(region, stbt.Region(0, 0, 320, 240))
+        ocr_regions.append(region)
+        if not region.contains(text_region):
+            return u"", region
+        box = text_region.translate(-region.x, -region.y)
+        return ((
+            '<html xmlns="http://www.w3.org/1999/xhtml"><body>'
+            '<span class="ocrx_word" title="bbox %d %d %d %d">hello</span>'
+            '</body></html>') % (box.x * 3, box.y * 3, box.right * 3,
+                                 box.bottom * 3),
+                region)
+
+    monkeypatch.setattr(_stbt.ocr, "_tesseract", _tesseract)
+    monkeypatch.setattr(_stbt.ocr, "_tesseract_version",
+                        lambda: LooseVersion("4.0.0"))
+
+    res = stbt.wait_for_text("hello", consecutive_matches=3,
+                             frames=_frames(frame, frame, frame))
+    assert res.region == text_region
+    near = text_region.extend(x=-10, y=-10, right=10, bottom=10)
+    assert ocr_regions == [stbt.Region(0, 0, 320, 240), near, near]
+
+
+def test_that_text_regions_of_last_frame_notices_changes_to_the_frame():
+    import numpy
+    from _stbt.ocr import _TextRegionsOfLastFrame
+
+    frame = numpy.array(load_image("ocr/menu.png"))
+    find_text_regions = _TextRegionsOfLastFrame()
+    assert find_text_regions(frame, stbt.Region.ALL)
+    frame[...] = 255
+    assert find_text_regions(frame, stbt.Region.ALL) == []
+
+
 def test_match_text_stringify_result():
     frame = load_image("ocr/menu.png")
     result = stbt.match_text(u"Onion Bhaji", frame=frame)
@@ -334,6 +462,35 @@ def test_ocr_text_color_threshold():
         assert stbt.ocr(f, text_color=c) == "Guide"
 
 
+@pytest.mark.parametrize("color,threshold", [
+    ((220, 220, 220), 25),
+    ((0, 0, 0), 0),
+    ((255, 128, 3), 50),
+    ((20, 200, 100), 254),
+])
+def test_text_color_threshold_is_equivalent_to_distance_formula(
+        color, threshold):
+    import numpy
+    from _stbt.logging import ImageLogger
+    from _stbt.ocr import _text_color_threshold
+
+    frame = load_image("ocr/blue-search-white-guide.png")
+    frame = numpy.concatenate([
+        frame,
+        numpy.random.RandomState(0).randint(
+            0, 256, size=(100, frame.shape[1], 3)).astype(numpy.uint8)])
+
+    diff = numpy.subtract(frame, color, dtype=numpy.int32)
+    distance = numpy.sqrt((diff[:, :, 0] ** 2 +
+                           diff[:, :, 1] ** 2 +
+                           diff[:, :, 2] ** 2) // 3).astype(numpy.uint8)
+    _, expected = cv2.threshold(distance, threshold, 255, cv2.THRESH_BINARY)
+
+    assert numpy.array_equal(
+        _text_color_threshold(frame, color, threshold, ImageLogger("test")),
+        expected)
+
+
 def test_that_ocr_engine_has_an_effect():
     if _tesseract_version() < LooseVersion("4.0"):
         raise SkipTest('tesseract is too old')
@@ -348,3 +505,220 @@ def test_that_ocr_engine_has_an_effect():
     assert "sillyness" in stbt.ocr(f, engine=stbt.OcrEngine.LSTM)
     with temporary_config({'ocr.engine': 'LSTM'}):
         assert "sillyness" in stbt.ocr(f)
+
+
+def test_that_libtesseract_gives_the_same_results_as_the_executable():
+    from _stbt import libtesseract
+    if libtesseract.version() is None:
+        raise SkipTest("libtesseract isn't installed")
+
+    f = load_image("ocr/small.png")
+    results = []
+    for use_libtesseract in ["false", "true", "true"]:
+        with temporary_config({"ocr.use_libtesseract": use_libtesseract}):
+            results.append((
+                stbt.ocr(f),
+                stbt.ocr(f, tesseract_user_words=["magnify"]),
+                stbt.match_text("anti-aliased", f).region))
+    assert results[0] == results[1] == results[2]
+
+
+def test_that_match_text_reuses_libtesseract_for_the_same_text():
+    from _stbt import libtesseract
+    from _stbt.ocr import _last_results, _tesseract_pool
+    if libtesseract.version() is None:
+        raise SkipTest("libtesseract isn't installed")
+
+    f = load_image("ocr/small.png")
+    _tesseract_pool.close()
+    with temporary_config({"ocr.use_libtesseract": "true"}):
+        for _ in range(2):
+            _last_results.clear()
+            assert stbt.match_text("anti-aliased", f)
+    assert len(_tesseract_pool._idle) == 1  # pylint:disable=protected-access
+
+
+def test_that_debug_doesnt_change_the_choice_of_tesseract_engine(
+        monkeypatch):
+    import _stbt.ocr
+    from _stbt.logging import scoped_debug_level
+    from _stbt.utils import scoped_curdir
+    calls = []
+
+    def _tesseract_library(frame, mode, lang, oem, _config, user_words,
+                           *_):
+        calls.append((_config, user_words))
+        return _stbt.ocr._HOCR_TEMPLATE % u""  # pylint:disable=protected-access
+
+    monkeypatch.setattr(_stbt.ocr, "_use_libtesseract", lambda _: True)
+    monkeypatch.setattr(_stbt.ocr, "_tesseract_library", _tesseract_library)
+    monkeypatch.setattr(_stbt.ocr, "_tesseract_version",
+                        lambda: LooseVersion("4.0.0"))
+    _stbt.ocr._last_results.clear()  # pylint:disable=protected-access
+
+    f = load_image("ocr/small.png")
+    stbt.match_text("magnify", f)
+    with scoped_curdir(), scoped_debug_level(2):
+        stbt.match_text("magnify", f)
+    assert len(calls) == 2
+    assert calls[0] == calls[1]
+    assert calls[0][1] == ["magnify"]
+
+
+def test_that_tesseract_workers_are_reused():
+    from _stbt.ocr import _TesseractPool
+
+    class FakeWorker(object):
+        def __init__(self):
+            self.closed = False
+
+        def close(self):
+            self.closed = True
+
+    pool = _TesseractPool(max_configs=2)
+    with pool.worker("a", FakeWorker) as a:
+        with pool.worker("a", FakeWorker) as a2:
+            assert a2 is not a  # Concurrent users get their own worker
+    with pool.worker("a", FakeWorker) as w:
+        assert w in (a, a2)
+
+    with pytest.raises(RuntimeError):
+        with pool.worker("b", FakeWorker) as b:
+            raise RuntimeError()
+    assert b.closed  # Not reused after an error
+
+    with pool.worker("b", FakeWorker):
+        pass
+    with pool.worker("c", FakeWorker):
+        pass
+    assert a.closed and a2.closed  # Only keeps 2 configs
+    pool.close()
+
+
+def test_ocr_many():
+    f = load_image("ocr/Connection-status--white-on-dark-blue.png")
+    regions = [stbt.Region.ALL,
+               stbt.Region(x=210, y=0, width=120, height=40),
+               stbt.Region(x=0, y=0, width=200, height=40),
+               stbt.Region(x=2000, y=0, width=10, height=10)]  # Outside frame
+    expected = [stbt.ocr(f, r) for r in regions]
+    assert expected[1] == "Connected"
+    assert stbt.ocr_many(f, regions) == expected
+    assert stbt.ocr_many(f, []) == []
+
+
+def test_that_staged_tessdata_directories_are_reused(monkeypatch):
+    from _stbt.ocr import _TessdataCache
+
+    with named_temporary_directory() as srcdir:
+        os.makedirs(srcdir + "/tessdata/configs")
+        open(srcdir + "/tessdata/eng.traineddata", "w").close()
+        monkeypatch.setenv("TESSDATA_PREFIX", srcdir + "/tessdata")
+        v = LooseVersion("4.0.0")
+
+        cache = _TessdataCache(max_entries=2)
+        a = cache.acquire("", "eng", {"x": 1}, ["word"], None, v)
+        assert os.path.isfile(a.prefix + "/configs/stbtester")
+        assert os.path.isfile(a.prefix + "/eng.traineddata")
+        with open(a.prefix + "/eng.user-words") as f:
+            assert f.read() == "word"
+        cache.release(a)
+        assert cache.acquire("", "eng", {"x": 1}, ["word"], None, v) is a
+
+        b = cache.acquire("", "eng", {"x": 1}, ["other"], None, v)
+        cache.release(b)
+        c = cache.acquire("", "eng", {"x": 2}, ["word"], None, v)
+        cache.release(c)
+        assert b is not a and c is not a
+        # `a` has been evicted, but it's still in use:
+        assert os.path.exists(a.path)
+        cache.release(a)
+        assert not os.path.exists(a.path)
+
+        cache.clear()
+        assert not os.path.exists(b.path)
+
+
+def test_that_ocr_doesnt_need_a_temporary_directory(monkeypatch):
+    import _stbt.ocr
+
+    class FakePopen(object):
+        returncode = 0
+
+        def __init__(self, cmd, cwd, **_):
+            assert cmd[3:5] == ["stdin", "stdout"]
+            assert cwd is None
+
+        def communicate(self, _):
+            return b"text", b""
+
+    def named_temporary_directory(*_, **__):
+        assert False, "Unexpected temporary directory"
+
+    monkeypatch.setattr(_stbt.ocr.subprocess, "Popen", FakePopen)
+    monkeypatch.setattr(_stbt.ocr, "named_temporary_directory",
+                        named_temporary_directory)
+    monkeypatch.setattr(_stbt.ocr, "_tesseract_version",
+                        lambda: LooseVersion("4.0.0"))
+    _stbt.ocr._last_results.clear()  # pylint:disable=protected-access
+
+    with temporary_config({"ocr.use_libtesseract": "false"}):
+        assert stbt.ocr(load_image("ocr/small.png")) == "text"
+
+
+def test_that_ocr_is_skipped_if_the_region_hasnt_changed(monkeypatch):
+    import numpy
+    import _stbt.ocr
+    calls = []
+
+    def _tesseract_subprocess(frame, *_):
+        calls.append(frame.shape)
+        return u"text %i" % len(calls)
+
+    monkeypatch.setattr(_stbt.ocr, "_tesseract_subprocess",
+                        _tesseract_subprocess)
+    monkeypatch.setattr(_stbt.ocr, "_tesseract_version",
+                        lambda: LooseVersion("4.0.0"))
+    _stbt.ocr._last_results.clear()  # pylint:disable=protected-access
+
+    frame = load_image("ocr/menu.png")
+    region = stbt.Region(40, 120, 240, 80)
+    assert stbt.ocr(frame, region) == "text 1"
+    assert stbt.ocr(frame.copy(), region) == "text 1"
+    assert len(calls) == 1
+
+    # Different parameters or region:
+    assert stbt.ocr(frame, region, lang="deu") == "text 2"
+    assert stbt.ocr(frame, region.extend(right=1)) == "text 3"
+    assert stbt.ocr(frame, region) == "text 1"
+
+    # Changes outside the region don't matter:
+    changed = frame.copy()
+    changed[0:100] = 0
+    assert stbt.ocr(changed, region) == "text 1"
+    assert len(calls) == 3
+
+    changed[150, 100] = numpy.array([10, 20, 30])
+    assert stbt.ocr(changed, region) == "text 4"
+    assert len(calls) == 4
+
+    # Parameters that we don't know how to hash:
+    config = {"tessedit_char_blacklist": object()}
+    assert stbt.ocr(frame, region, tesseract_config=config) == "text 5"
+    assert stbt.ocr(frame, region, tesseract_config=config) == "text 6"
+
+
+def test_encode_pnm():
+    import numpy
+    from _stbt.ocr import _encode_pnm
+
+    frame = load_image("ocr/small.png")
+    with named_temporary_directory() as tmpdir:
+        for f, ext in [(frame[10:50, 20:200], "ppm"),
+                       (frame[10:50, 20:200, 1], "pgm")]:
+            with open("%s/image.%s" % (tmpdir, ext), "wb") as out:
+                out.write(_encode_pnm(f))
+            decoded = cv2.imread("%s/image.%s" % (tmpdir, ext),
+                                 cv2.IMREAD_UNCHANGED)
+            assert numpy.array_equal(decoded, f)
+    assert _encode_pnm(frame.astype(numpy.float32)) is None